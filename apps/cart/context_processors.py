@@ -0,0 +1,18 @@
+from django.utils.functional import SimpleLazyObject
+from cart.utils import get_cart_count
+
+
+def get_request_cart_count(request):
+    '''
+    获取登录用户购物车中商品的条目数，同一个请求只查询一次redis
+    视图已经获取过时可以设置request._cart_count，不再查询
+    '''
+    if not hasattr(request, '_cart_count'):
+        user = request.user
+        request._cart_count = get_cart_count(user.id) if user.is_authenticated() else 0
+    return request._cart_count
+
+
+def cart_count(request):
+    '''页面头部的购物车商品数量，模板中用到时才查询'''
+    return {'cart_count': SimpleLazyObject(lambda: get_request_cart_count(request))}
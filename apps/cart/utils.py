@@ -0,0 +1,193 @@
+# 购物车记录的修改都在redis中用lua脚本原子地完成，一次往返返回修改结果和购物车的合计
+# cart_用户id: {sku_id: 商品数目}
+# cart_total_用户id: 购物车中商品的总件数
+# 同一个用户的key由utils.redis_router分配到同一个redis节点
+from django.conf import settings
+from utils.redis_router import get_user_connection
+
+# 购物车中商品的总件数单独保存，和购物车记录在同一个脚本中修改，读取总件数不需要遍历购物车
+# 总件数不存在时(例如之前创建的购物车)从购物车记录计算一次
+# 购物车在settings.CART_TTL时间内没有访问时过期
+CART_TOTAL_LUA = '''
+local function cart_total(key, total_key)
+    local total = redis.call('get', total_key)
+    if total then
+        return tonumber(total)
+    end
+    total = 0
+    for _, val in ipairs(redis.call('hvals', key)) do
+        total = total + tonumber(val)
+    end
+    redis.call('set', total_key, total)
+    return total
+end
+
+local function incr_total(key, total_key, delta)
+    local total = cart_total(key, total_key)
+    if delta == 0 then
+        -- lua中的-0会被转换成字符串'-0'，incrby不接受
+        return total
+    end
+    return redis.call('incrby', total_key, delta)
+end
+
+-- 最后一个参数是购物车的过期时间，每次访问购物车时重新设置
+local cart_ttl = tonumber(table.remove(ARGV))
+
+local function done(result)
+    if cart_ttl > 0 then
+        redis.call('expire', KEYS[1], cart_ttl)
+        redis.call('expire', KEYS[2], cart_ttl)
+    end
+    return result
+end
+'''
+
+# 添加购物车记录: 已有的商品数目累加, 超过库存时不修改
+# KEYS: cart_key, cart_total_key  ARGV: sku_id, count, stock, ttl
+# 返回{是否成功, 购物车中商品的条目数, 购物车中商品的总件数}
+CART_ADD_LUA = CART_TOTAL_LUA + '''
+local old = tonumber(redis.call('hget', KEYS[1], ARGV[1]) or '0')
+local count = old + tonumber(ARGV[2])
+if count > tonumber(ARGV[3]) then
+    return done({0, redis.call('hlen', KEYS[1]), cart_total(KEYS[1], KEYS[2])})
+end
+local total = incr_total(KEYS[1], KEYS[2], count - old)
+redis.call('hset', KEYS[1], ARGV[1], count)
+return done({1, redis.call('hlen', KEYS[1]), total})
+'''
+
+# 更新购物车记录: 设置商品数目, 超过库存时不修改
+# KEYS: cart_key, cart_total_key  ARGV: sku_id, count, stock, ttl
+CART_UPDATE_LUA = CART_TOTAL_LUA + '''
+local count = tonumber(ARGV[2])
+if count > tonumber(ARGV[3]) then
+    return done({0, redis.call('hlen', KEYS[1]), cart_total(KEYS[1], KEYS[2])})
+end
+local old = tonumber(redis.call('hget', KEYS[1], ARGV[1]) or '0')
+local total = incr_total(KEYS[1], KEYS[2], count - old)
+redis.call('hset', KEYS[1], ARGV[1], count)
+return done({1, redis.call('hlen', KEYS[1]), total})
+'''
+
+# 删除购物车记录
+# KEYS: cart_key, cart_total_key  ARGV: sku_id, ..., ttl
+CART_DELETE_LUA = CART_TOTAL_LUA + '''
+local removed = 0
+for _, sku_id in ipairs(ARGV) do
+    removed = removed + tonumber(redis.call('hget', KEYS[1], sku_id) or '0')
+end
+local total = incr_total(KEYS[1], KEYS[2], -removed)
+redis.call('hdel', KEYS[1], unpack(ARGV))
+return done({1, redis.call('hlen', KEYS[1]), total})
+'''
+
+# 批量修改购物车记录
+# KEYS: cart_key, cart_total_key  ARGV: sku_id, count, stock, sku_id, count, stock, ..., ttl
+# count为空字符串时删除记录, 否则设置商品数目, 超过库存时不修改
+# 返回{购物车中商品的条目数, 购物车中商品的总件数, 每个操作是否成功...}
+CART_BATCH_LUA = CART_TOTAL_LUA + '''
+local results = {}
+local delta = 0
+for i = 1, #ARGV, 3 do
+    local sku_id = ARGV[i]
+    local old = tonumber(redis.call('hget', KEYS[1], sku_id) or '0')
+    if ARGV[i + 1] == '' then
+        redis.call('hdel', KEYS[1], sku_id)
+        delta = delta - old
+        table.insert(results, 1)
+    elseif tonumber(ARGV[i + 1]) > tonumber(ARGV[i + 2]) then
+        table.insert(results, 0)
+    else
+        redis.call('hset', KEYS[1], sku_id, ARGV[i + 1])
+        delta = delta + tonumber(ARGV[i + 1]) - old
+        table.insert(results, 1)
+    end
+end
+local total = incr_total(KEYS[1], KEYS[2], delta)
+return done({redis.call('hlen', KEYS[1]), total, unpack(results)})
+'''
+
+
+def cart_key(user_id):
+    return 'cart_%d' % user_id
+
+
+def cart_total_key(user_id):
+    return 'cart_total_%d' % user_id
+
+
+def _run(script, user_id, *args):
+    conn = get_user_connection(user_id)
+    keys = [cart_key(user_id), cart_total_key(user_id)]
+    args = args + (settings.CART_TTL,)
+    ok, cart_count, total_count = conn.register_script(script)(keys=keys, args=args)
+    return bool(ok), cart_count, total_count
+
+
+def get_cart(user_id):
+    '''
+    获取购物车记录和商品的总件数
+    返回({sku_id: 商品数目}, 购物车中商品的总件数)
+    '''
+    conn = get_user_connection(user_id)
+    pipe = conn.pipeline(transaction=False)
+    pipe.hgetall(cart_key(user_id))
+    pipe.get(cart_total_key(user_id))
+    if settings.CART_TTL:
+        # 访问购物车时重新设置过期时间
+        pipe.expire(cart_key(user_id), settings.CART_TTL)
+        pipe.expire(cart_total_key(user_id), settings.CART_TTL)
+    cart_dict, total_count = pipe.execute()[:2]
+
+    if total_count is None:
+        # 总件数还没有保存
+        total_count = sum(int(count) for count in cart_dict.values())
+    return cart_dict, int(total_count)
+
+
+def get_cart_count(user_id):
+    '''获取购物车中商品的条目数'''
+    return get_user_connection(user_id).hlen(cart_key(user_id))
+
+
+def add_to_cart(user_id, sku_id, count, stock):
+    '''
+    添加购物车记录，累加后的数目超过库存stock时不添加
+    返回(是否成功, 购物车中商品的条目数, 购物车中商品的总件数)
+    '''
+    return _run(CART_ADD_LUA, user_id, sku_id, count, stock)
+
+
+def update_cart(user_id, sku_id, count, stock):
+    '''
+    更新购物车记录，数目超过库存stock时不更新
+    返回(是否成功, 购物车中商品的条目数, 购物车中商品的总件数)
+    '''
+    return _run(CART_UPDATE_LUA, user_id, sku_id, count, stock)
+
+
+def delete_from_cart(user_id, *sku_ids):
+    '''
+    删除购物车记录
+    返回(购物车中商品的条目数, 购物车中商品的总件数)
+    '''
+    ok, cart_count, total_count = _run(CART_DELETE_LUA, user_id, *sku_ids)
+    return cart_count, total_count
+
+
+def batch_update_cart(user_id, ops):
+    '''
+    批量修改购物车记录，在一次redis调用中完成
+    ops: [(sku_id, count, stock), ...], count为None时删除记录
+    返回([每个操作是否成功, ...], 购物车中商品的条目数, 购物车中商品的总件数)
+    '''
+    args = []
+    for sku_id, count, stock in ops:
+        args.extend([sku_id, '' if count is None else count, stock])
+
+    conn = get_user_connection(user_id)
+    keys = [cart_key(user_id), cart_total_key(user_id)]
+    result = conn.register_script(CART_BATCH_LUA)(keys=keys, args=args + [settings.CART_TTL])
+    cart_count, total_count = result[0], result[1]
+    return [bool(ok) for ok in result[2:]], cart_count, total_count
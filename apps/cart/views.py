@@ -3,8 +3,11 @@ from django.views.generic import View
 from django.http import JsonResponse
 
 from goods.models import GoodsSKU
+from goods.sku_cache import get_sku, get_skus
+from goods.stock import get_stock, get_stocks
+from cart.utils import add_to_cart, update_cart, delete_from_cart, get_cart, batch_update_cart
 from utils.mixin import LoginRequiredMixin
-from django_redis import get_redis_connection
+import json
 # Create your views here.
 # 采用ajax发起请求
 # 浏览器需要传递的数据: 商品id->sku_id 商品数目->count
@@ -45,32 +48,18 @@ class CartAddView(View):
             # 商品数目出错
             return JsonResponse({'res':2, 'errmsg':'商品数目出错'})
 
-        # 校验商品是否存在
-        try:
-            sku = GoodsSKU.objects.get(id=sku_id)
-        except GoodsSKU.DoesNotExist:
+        # 校验商品是否存在，同时从redis中的库存镜像获取商品的库存
+        stock = get_stock(sku_id)
+        if stock is None:
             # 商品不存在
             return JsonResponse({'res':3, 'errmsg':'商品不存在'})
 
         # 业务处理:添加购物车记录
-        conn = get_redis_connection('default')
-        cart_key = 'cart_%d'%user.id
-        # 先尝试获取cart_key中sku_id的值
-        sku_count = conn.hget(cart_key, sku_id)
-        if sku_count:
-            # 如果购物车中商品已存在，数目需要累加
-            count += int(sku_count)
-
-        # 校验商品的库存
-        if count > sku.stock:
+        # 累加商品数目，校验商品的库存和获取用户购物车中商品的条目数在一次redis调用中完成
+        success, cart_count, total_count = add_to_cart(user.id, int(sku_id), count, stock)
+        if not success:
             return JsonResponse({'res': 4, 'errmsg': '商品库存不足'})
 
-        # 添加记录
-        conn.hset(cart_key, sku_id, count)
-
-        # 获取用户购物车中商品的条目数
-        cart_count = conn.hlen(cart_key)
-
         # 返回应答
         return JsonResponse({'res':5,'cart_count':cart_count, 'message':'添加成功'})
 
@@ -82,19 +71,25 @@ class CartInfoView(LoginRequiredMixin, View):
         '''显示'''
         # 获取登录用户
         user = request.user
-        # 获取用户购物车中商品的信息
-        conn = get_redis_connection('default')
-        cart_key = 'cart_%d'%user.id
+        # 获取用户购物车中商品的信息和商品的总件数
         # {'商品id':商品数目, ....}
-        cart_dict = conn.hgetall(cart_key)
+        cart_dict, total_count = get_cart(user.id)
+
+        # 一次获取购物车中全部商品的信息
+        sku_dict = get_skus(cart_dict.keys())
 
         skus = []
-        # 分别保存用户购物车中商品的总件数和总价格
-        total_count = 0
+        # 保存用户购物车中商品的总价格
         total_price = 0
+        # 已经删除的商品
+        removed = []
+        # 按照购物车中的顺序显示
         for sku_id,count in cart_dict.items():
-            # 根据sku_id获取商品的信息
-            sku = GoodsSKU.objects.get(id=sku_id)
+            sku = sku_dict.get(int(sku_id))
+            if sku is None:
+                # 商品已经不存在
+                removed.append(sku_id)
+                continue
             # 计算商品的小计
             amount = sku.price*int(count)
             # 动态给sku对象增加一个属性amount,保存商品的小计
@@ -103,10 +98,13 @@ class CartInfoView(LoginRequiredMixin, View):
             sku.count = count
             # 添加
             skus.append(sku)
-            # 累加计算商品的总件数和总价格
-            total_count += int(count)
+            # 累加计算商品的总价格
             total_price += amount
 
+        if removed:
+            # 从购物车中删除不存在的商品，总件数和显示的商品一致
+            cart_count, total_count = delete_from_cart(user.id, *removed)
+
         # 组织上下文
         context = {'total_count':total_count,
                    'total_price':total_price,
@@ -145,30 +143,18 @@ class CartUpdateView(View):
             # 商品数目出错
             return JsonResponse({'res': 2, 'errmsg': '商品数目出错'})
 
-        # 校验商品是否存在
-        try:
-            sku = GoodsSKU.objects.get(id=sku_id)
-        except GoodsSKU.DoesNotExist:
+        # 校验商品是否存在，同时从redis中的库存镜像获取商品的库存
+        stock = get_stock(sku_id)
+        if stock is None:
             # 商品不存在
             return JsonResponse({'res': 3, 'errmsg': '商品不存在'})
 
         # 业务处理:购物记录更新
-        conn = get_redis_connection('default')
-        cart_key = 'cart_%d'%user.id
-
-        # 校验商品的库存
-        if count > sku.stock:
+        # 校验商品的库存，更新和获取购物车中全部商品的总件数在一次redis调用中完成
+        success, cart_count, total_count = update_cart(user.id, int(sku_id), count, stock)
+        if not success:
             return JsonResponse({'res':4, 'errmsg':'商品库存不足'})
 
-        # 更新
-        conn.hset(cart_key, sku_id, count)
-
-        # 获取购物车中全部商品的总件数
-        total_count = 0
-        vals = conn.hvals(cart_key)
-        for val in vals:
-            total_count += int(val)
-
         # 返回应答
         return JsonResponse({'res':5, 'total_count':total_count, 'message':'更新成功'})
 
@@ -196,23 +182,14 @@ class CartDeleteView(View):
 
         # 校验商品是否存在
         try:
-            sku = GoodsSKU.objects.get(id=sku_id)
+            sku = get_sku(sku_id)
         except GoodsSKU.DoesNotExist:
             # 商品不存在
             return JsonResponse({'res':2, 'errmsg':'商品不存在'})
 
         # 业务处理:删除购物车记录
-        conn = get_redis_connection('default')
-        cart_key = 'cart_%d'%user.id
-
-        # 删除:从cart_key对应的元素中删除sku_id
-        conn.hdel(cart_key, sku_id)
-
-        # 获取购物车中全部商品的总件数
-        total_count = 0
-        vals = conn.hvals(cart_key)
-        for val in vals:
-            total_count += int(val)
+        # 删除和获取购物车中全部商品的总件数在一次redis调用中完成
+        cart_count, total_count = delete_from_cart(user.id, sku.id)
 
         # 返回应答
         return JsonResponse({'res':3, 'total_count':total_count, 'message':'删除成功'})
@@ -228,3 +205,81 @@ class CartDeleteView(View):
 
 
 
+
+
+# 批量修改购物车记录
+# 采用ajax post 请求
+# 前端需要传递的参数: ops->json格式的操作列表
+# [{"sku_id": 商品id, "count": 商品数目}, {"sku_id": 商品id, "delete": true}, ...]
+# /cart/batch
+class CartBatchView(View):
+    '''购物车记录批量修改'''
+    def post(self, request):
+        '''购物车记录批量修改'''
+        # 判断用户是否登录
+        user = request.user
+        if not user.is_authenticated():
+            # 用户没有登录
+            return JsonResponse({'res': 0, 'errmsg': '请先登录'})
+
+        # 接收数据, 也可以直接使用json格式的请求体
+        ops = request.POST.get('ops')
+        if ops is None and request.META.get('CONTENT_TYPE', '').startswith('application/json'):
+            ops = request.body.decode()
+
+        # 校验参数
+        try:
+            ops = json.loads(ops)
+        except Exception as e:
+            return JsonResponse({'res': 1, 'errmsg': '参数不完整'})
+        if not isinstance(ops, list) or not ops or not all(isinstance(op, dict) for op in ops):
+            return JsonResponse({'res': 1, 'errmsg': '参数不完整'})
+
+        # 一次获取全部商品的库存
+        sku_ids = []
+        for op in ops:
+            try:
+                sku_ids.append(int(op.get('sku_id')))
+            except Exception as e:
+                sku_ids.append(None)
+        stocks = get_stocks([sku_id for sku_id in sku_ids if sku_id is not None])
+
+        # 分别校验每个操作，每个操作的结果和单独修改时的返回值一致
+        results = []
+        valid = []
+        for op, sku_id in zip(ops, sku_ids):
+            stock = stocks.get(sku_id)
+            if stock is None:
+                # 商品不存在
+                results.append({'sku_id': op.get('sku_id'), 'res': 3, 'errmsg': '商品不存在'})
+                continue
+
+            if op.get('delete'):
+                count = None
+            else:
+                # 校验商品的数目
+                try:
+                    count = int(op.get('count'))
+                except Exception as e:
+                    results.append({'sku_id': sku_id, 'res': 2, 'errmsg': '商品数目出错'})
+                    continue
+
+            results.append({'sku_id': sku_id})
+            valid.append((results[-1], (sku_id, count, stock)))
+
+        # 业务处理: 全部校验通过的操作在一次redis调用中完成
+        cart_count = total_count = None
+        if valid:
+            oks, cart_count, total_count = batch_update_cart(user.id, [op for result, op in valid])
+            for (result, op), ok in zip(valid, oks):
+                if ok:
+                    result.update({'res': 5, 'message': '修改成功'})
+                else:
+                    result.update({'res': 4, 'errmsg': '商品库存不足'})
+        else:
+            cart_dict, total_count = get_cart(user.id)
+            cart_count = len(cart_dict)
+
+        # 返回应答
+        return JsonResponse({'res': 5, 'cart_count': cart_count, 'total_count': total_count,
+                             'results': results, 'message': '修改完成'})
@@ -1,52 +1,108 @@
 from django.contrib import admin
-from django.core.cache import cache
-from goods.models import GoodsType,IndexPromotionBanner,IndexGoodsBanner, IndexTypeGoodsBanner
+from goods.models import GoodsType, GoodsSKU, IndexPromotionBanner,IndexGoodsBanner, IndexTypeGoodsBanner
+from goods.rankings import update_sku_rankings, remove_sku_rankings
+from goods.stock import set_stocks, remove_stocks
+from goods.utils import bump_index_fragments, type_banners_fragment, invalidate_new_skus, invalidate_type_sku_count
 # Register your models here.
 
 
 class BaseModelAdmin(admin.ModelAdmin):
+    def get_index_fragments(self, obj, form=None):
+        '''返回数据变化后需要重新生成的首页缓存片段'''
+        return []
+
     def save_model(self, request, obj, form, change):
         '''新增或修改数据表中的数据时调用'''
         # 调用父类的方法
         super().save_model(request, obj, form, change)
 
-        # 重新生成首页静态页面
+        # 只让受影响的首页缓存片段失效
+        bump_index_fragments(*self.get_index_fragments(obj, form))
+
+        # 缓存片段失效之后再重新生成首页静态页面
         from celery_tasks.tasks import generate_static_index_html
         generate_static_index_html.delay()
 
-        # 清除首页缓存数据
-        cache.delete('index_page_data')
-
     def delete_model(self, request, obj):
         '''删除数据表中的数据时调用'''
+        # 删除之前确定受影响的首页缓存片段
+        fragments = self.get_index_fragments(obj)
+
         # 调用父类的方法
         super().delete_model(request, obj)
 
-        # 重新生成首页静态页面
+        # 只让受影响的首页缓存片段失效
+        bump_index_fragments(*fragments)
+
+        # 缓存片段失效之后再重新生成首页静态页面
         from celery_tasks.tasks import generate_static_index_html
         generate_static_index_html.delay()
 
-        # 清除首页缓存数据
-        cache.delete('index_page_data')
-
 
 class GoodsTypeAdmin(BaseModelAdmin):
-    pass
+    def get_index_fragments(self, obj, form=None):
+        return ['types']
 
 
 class IndexGoodsBannerAdmin(BaseModelAdmin):
-    pass
+    def get_index_fragments(self, obj, form=None):
+        return ['goods_banners']
 
 
 class IndexTypeGoodsBannerAdmin(BaseModelAdmin):
-    pass
+    def get_index_fragments(self, obj, form=None):
+        type_ids = {obj.type_id}
+        if form is not None and form.initial.get('type'):
+            # 修改了商品所属的分类，原来分类的楼层也需要更新
+            type_ids.add(form.initial['type'])
+        return [type_banners_fragment(type_id) for type_id in type_ids]
 
 
 class IndexPromotionBannerAdmin(BaseModelAdmin):
-    pass
+    def get_index_fragments(self, obj, form=None):
+        return ['promotion_banners']
+
+
+class GoodsSKUAdmin(BaseModelAdmin):
+    def get_index_fragments(self, obj, form=None):
+        # 商品可能出现在首页的轮播商品和分类楼层中
+        type_ids = set(IndexTypeGoodsBanner.objects.filter(sku_id=obj.id).values_list('type_id', flat=True))
+        return ['goods_banners'] + [type_banners_fragment(type_id) for type_id in type_ids]
+
+    def refresh_catalog(self, obj, form=None):
+        '''商品变化后更新分类的新品信息，增量生成详情页和列表页静态页'''
+        type_ids = {obj.type_id}
+        if form is not None and form.initial.get('type'):
+            type_ids.add(form.initial['type'])
+        for type_id in type_ids:
+            invalidate_new_skus(type_id)
+            invalidate_type_sku_count(type_id)
+
+        from celery_tasks.tasks import generate_static_catalog
+        generate_static_catalog.delay()
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        self.refresh_catalog(obj, form)
+
+        # 更新商品在分类排行中的价格和销量
+        update_sku_rankings(obj, form.initial.get('type'))
+        # 更新库存镜像
+        set_stocks({obj.id: obj.stock})
+
+    def delete_model(self, request, obj):
+        # 删除之后obj.id为None
+        sku_id = obj.id
+        super().delete_model(request, obj)
+        self.refresh_catalog(obj)
+
+        # 从分类排行和库存镜像中移除商品
+        remove_sku_rankings(sku_id, obj.type_id)
+        remove_stocks([sku_id])
 
 
 admin.site.register(GoodsType,GoodsTypeAdmin)
 admin.site.register(IndexGoodsBanner, IndexGoodsBannerAdmin)
 admin.site.register(IndexTypeGoodsBanner, IndexTypeGoodsBannerAdmin)
-admin.site.register(IndexPromotionBanner, IndexPromotionBannerAdmin)
\ No newline at end of file
+admin.site.register(IndexPromotionBanner, IndexPromotionBannerAdmin)
+admin.site.register(GoodsSKU, GoodsSKUAdmin)
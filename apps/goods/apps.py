@@ -0,0 +1,13 @@
+from django.apps import AppConfig
+from django.db.models.signals import post_save, post_delete
+
+
+class GoodsConfig(AppConfig):
+    name = 'goods'
+
+    def ready(self):
+        # 商品保存或删除时清除商品缓存
+        from goods.models import GoodsSKU
+        from goods.sku_cache import sku_changed
+        post_save.connect(sku_changed, sender=GoodsSKU, dispatch_uid='goods_sku_cache_save')
+        post_delete.connect(sku_changed, sender=GoodsSKU, dispatch_uid='goods_sku_cache_delete')
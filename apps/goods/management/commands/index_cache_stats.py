@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from goods.utils import get_index_fragment_stats, reset_index_fragment_stats
+
+
+class Command(BaseCommand):
+    '''显示首页缓存片段的命中率和重建耗时'''
+    help = '显示首页缓存片段的命中率和重建耗时'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='显示后清空统计数据')
+
+    def handle(self, *args, **options):
+        stats = get_index_fragment_stats()
+
+        self.stdout.write('%-24s %10s %10s %10s %10s %16s' % ('fragment', 'hits', 'stale', 'misses',
+                                                              'hit_ratio', 'avg_rebuild_ms'))
+        for name in sorted(stats):
+            item = stats[name]
+            self.stdout.write('%-24s %10d %10d %10d %9.2f%% %16.2f' % (name, item['hits'], item['stale'], item['misses'],
+                                                                       item['hit_ratio'] * 100, item['avg_rebuild_ms']))
+
+        if options['reset']:
+            reset_index_fragment_stats()
+            self.stdout.write('统计数据已清空')
@@ -0,0 +1,131 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from goods.models import GoodsType, GoodsSKU
+from goods.rankings import rebuild_type_rankings
+from goods.stock import reconcile_stocks
+from goods import sku_cache
+from goods.utils import build_fixed_fragments, build_type_banners_fragments, build_index_page_data
+from goods.utils import type_banners_fragment, warm_index_fragments, warm_new_skus
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import time
+
+
+# 预热的热门商品数目
+HOT_SKUS_COUNT = 500
+
+
+def warm_index(dry_run):
+    '''首页的轮播商品, 促销活动和分类楼层'''
+    type_ids = list(GoodsType.objects.values_list('id', flat=True))
+    count = warm_index_fragments(['goods_banners', 'promotion_banners'], build_fixed_fragments, dry_run)
+    count += warm_index_fragments([type_banners_fragment(type_id) for type_id in type_ids],
+                                  build_type_banners_fragments, dry_run)
+    return count
+
+
+def warm_types(dry_run):
+    '''商品的分类信息'''
+    return warm_index_fragments(['types'], build_fixed_fragments, dry_run)
+
+
+def warm_skus(dry_run):
+    '''每个分类的新品推荐'''
+    type_ids = list(GoodsType.objects.values_list('id', flat=True))
+    return warm_new_skus(type_ids, dry_run)
+
+
+def warm_rankings(dry_run):
+    '''每个分类的商品排行'''
+    type_ids = list(GoodsType.objects.values_list('id', flat=True))
+    if dry_run:
+        return GoodsSKU.objects.filter(type_id__in=type_ids).count()
+    return sum(rebuild_type_rankings(type_id) for type_id in type_ids)
+
+
+def warm_hot_skus(dry_run):
+    '''销量最高的商品'''
+    sku_ids = list(GoodsSKU.objects.order_by('-sales').values_list('id', flat=True)[:HOT_SKUS_COUNT])
+    if dry_run:
+        return len(GoodsSKU.objects.select_related('type', 'goods').in_bulk(sku_ids))
+    return sku_cache.warm_skus(sku_ids)
+
+
+def warm_stocks(dry_run):
+    '''商品的库存镜像'''
+    if dry_run:
+        return GoodsSKU.objects.count()
+    return reconcile_stocks()
+
+
+def warm_static(dry_run):
+    '''首页静态页static/index.html'''
+    from celery_tasks.tasks import render_static_index_html, generate_static_index_html
+    if dry_run:
+        render_static_index_html(build_index_page_data())
+    else:
+        # 直接在当前进程中执行任务
+        generate_static_index_html()
+    return 1
+
+
+# 可以预热的缓存
+WARMERS = OrderedDict([
+    ('index', warm_index),
+    ('types', warm_types),
+    ('new_skus', warm_skus),
+    ('rankings', warm_rankings),
+    ('hot_skus', warm_hot_skus),
+    ('stocks', warm_stocks),
+    ('static', warm_static),
+])
+
+
+def run_warmer(name, dry_run):
+    '''执行一个缓存的预热，返回(是否成功, 数目或者错误信息, 耗时)'''
+    start = time.time()
+    try:
+        result = (True, WARMERS[name](dry_run))
+    except Exception as e:
+        result = (False, repr(e))
+    finally:
+        # 每个线程使用自己的数据库连接，用完关闭
+        connection.close()
+    return result + (time.time() - start,)
+
+
+class Command(BaseCommand):
+    '''部署之后，在接收请求之前从数据库预热缓存'''
+    help = '部署之后，在接收请求之前从数据库预热缓存'
+
+    def add_arguments(self, parser):
+        parser.add_argument('families', nargs='*',
+                            help='要预热的缓存: %s, 默认全部' % ', '.join(WARMERS.keys()))
+        parser.add_argument('--dry-run', action='store_true', help='只查询数据库并统计耗时，不写入缓存')
+        parser.add_argument('--workers', type=int, default=len(WARMERS), help='并行预热的线程数')
+
+    def handle(self, *args, **options):
+        families = options['families'] or list(WARMERS.keys())
+        unknown = [name for name in families if name not in WARMERS]
+        if unknown:
+            raise CommandError('未知的缓存: %s' % ', '.join(unknown))
+        dry_run = options['dry_run']
+
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=max(options['workers'], 1)) as executor:
+            futures = OrderedDict((name, executor.submit(run_warmer, name, dry_run)) for name in families)
+            results = OrderedDict((name, future.result()) for name, future in futures.items())
+
+        failed = []
+        for name, (ok, detail, elapsed) in results.items():
+            if ok:
+                self.stdout.write('%-10s ok      %8.1fms  %s' % (name, elapsed * 1000, detail))
+            else:
+                failed.append(name)
+                self.stderr.write('%-10s failed  %8.1fms  %s' % (name, elapsed * 1000, detail))
+
+        self.stdout.write('%s完成，总耗时%.1fms' % ('试运行' if dry_run else '预热', (time.time() - start) * 1000))
+
+        if failed:
+            # 返回非0的退出码，发布流程根据退出码判断是否继续
+            raise CommandError('缓存预热失败: %s' % ', '.join(failed))
@@ -0,0 +1,117 @@
+# 列表页的商品排行: 每个分类的每种排序方式对应一个redis有序集合
+# type_rank_种类id_排序方式: {sku_id: 分数}
+# default->id倒序, price->价格正序(相同时id正序), hot->销量倒序(相同时id倒序)，和数据库查询的排序goods.utils.LIST_ORDERINGS一致
+from django_redis import get_redis_connection
+from goods.models import GoodsSKU
+
+# 分数相同时redis按照成员的字符串排序("9"在"10"之前)，和数据库的排序不一致
+# 分数 = 排序字段 * ID_SPAN + 商品id，商品id作为第二排序字段; 分数在2**53以内，double可以精确表示
+ID_SPAN = 10 ** 7
+
+# 排序方式: (分数, 是否倒序)
+RANK_SORTS = {
+    'default': (lambda sku: sku.id, True),
+    'price': (lambda sku: int(round(sku.price * 100)) * ID_SPAN + sku.id, False),
+    'hot': (lambda sku: sku.sales * ID_SPAN + sku.id, True),
+}
+
+
+def rank_key(type_id, sort):
+    return 'type_rank_%d_%s' % (int(type_id), sort)
+
+
+def _zadd(pipe, key, scores):
+    '''兼容不同版本redis-py的zadd参数'''
+    args = []
+    for member, score in scores.items():
+        args.extend([score, member])
+    pipe.execute_command('ZADD', key, *args)
+
+
+def update_sku_rankings(sku, old_type_id=None):
+    '''商品新增或修改后更新商品在分类排行中的分数'''
+    conn = get_redis_connection('default')
+    pipe = conn.pipeline()
+    for sort, (score, desc) in RANK_SORTS.items():
+        if old_type_id is not None and int(old_type_id) != sku.type_id:
+            # 修改了商品所属的分类
+            pipe.zrem(rank_key(old_type_id, sort), sku.id)
+        _zadd(pipe, rank_key(sku.type_id, sort), {sku.id: score(sku)})
+    pipe.execute()
+
+
+def remove_sku_rankings(sku_id, type_id):
+    '''删除商品后从分类排行中移除'''
+    conn = get_redis_connection('default')
+    pipe = conn.pipeline()
+    for sort in RANK_SORTS:
+        pipe.zrem(rank_key(type_id, sort), sku_id)
+    pipe.execute()
+
+
+def incr_sku_sales(sales):
+    '''
+    订单提交后增加商品在销量排行中的分数
+    sales: [(type_id, sku_id, count), ...]
+    '''
+    if not sales:
+        return
+    conn = get_redis_connection('default')
+    pipe = conn.pipeline(transaction=False)
+    for type_id, sku_id, count in sales:
+        # XX: 只更新排行中已有的商品，排行不存在时不创建，等待重建
+        pipe.execute_command('ZADD', rank_key(type_id, 'hot'), 'XX', 'INCR', int(count) * ID_SPAN, sku_id)
+    pipe.execute()
+
+
+def get_ranking_page(type_id, sort, page, per_page):
+    '''
+    从排行中获取第page页的商品id
+    返回(sku_ids, 总数目, 页码)，排行不存在时返回None
+    '''
+    key = rank_key(type_id, sort)
+    desc = RANK_SORTS[sort][1]
+
+    def page_ids(pipe, page):
+        start = (page - 1) * per_page
+        if desc:
+            pipe.zrevrange(key, start, start + per_page - 1)
+        else:
+            pipe.zrange(key, start, start + per_page - 1)
+
+    conn = get_redis_connection('default')
+    pipe = conn.pipeline(transaction=False)
+    pipe.zcard(key)
+    page_ids(pipe, page)
+    count, sku_ids = pipe.execute()
+
+    if count == 0:
+        return None
+
+    if not sku_ids and page > 1:
+        # 页码超出范围
+        page = 1
+        pipe = conn.pipeline(transaction=False)
+        page_ids(pipe, page)
+        sku_ids, = pipe.execute()
+
+    return [int(sku_id) for sku_id in sku_ids], count, page
+
+
+def rebuild_type_rankings(type_id):
+    '''从数据库重建分类的排行，先写入临时的key，再原子地替换'''
+    skus = list(GoodsSKU.objects.filter(type_id=type_id).only('id', 'type_id', 'price', 'sales'))
+
+    conn = get_redis_connection('default')
+    pipe = conn.pipeline()
+    for sort, (score, desc) in RANK_SORTS.items():
+        key = rank_key(type_id, sort)
+        if not skus:
+            pipe.delete(key)
+            continue
+        tmp_key = '%s_tmp' % key
+        pipe.delete(tmp_key)
+        _zadd(pipe, tmp_key, {sku.id: score(sku) for sku in skus})
+        pipe.rename(tmp_key, key)
+    pipe.execute()
+    return len(skus)
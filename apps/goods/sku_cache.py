@@ -0,0 +1,174 @@
+# 商品SKU的两级缓存: 进程内的LRU缓存 -> redis缓存 -> mysql
+# 商品保存时删除redis缓存，并通过redis的发布订阅通知所有进程删除进程内的缓存
+from django.conf import settings
+from django.core.cache import cache
+from django_redis import get_redis_connection
+from goods.models import GoodsSKU
+from collections import OrderedDict
+import copy
+import os
+import threading
+import time
+
+# 通知删除进程内缓存的频道
+SKU_INVALIDATE_CHANNEL = 'sku_invalidate'
+
+
+class LRUCache(object):
+    '''进程内有容量上限和过期时间的LRU缓存，线程安全'''
+    def __init__(self, maxsize, timeout):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires = item
+            if expires < time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.time() + self.timeout)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+_local = LRUCache(settings.SKU_LOCAL_CACHE_SIZE, settings.SKU_LOCAL_CACHE_TIMEOUT)
+
+# 订阅删除通知的线程，fork出的子进程需要重新订阅
+_subscriber_pid = None
+_subscriber_lock = threading.Lock()
+
+
+def _listen():
+    '''接收删除通知，删除进程内的缓存, 连接断开后重新订阅'''
+    while True:
+        try:
+            pubsub = get_redis_connection('default').pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(SKU_INVALIDATE_CHANNEL)
+            # 订阅之前的通知可能已经错过
+            _local.clear()
+            for message in pubsub.listen():
+                if message['type'] != 'message':
+                    continue
+                for sku_id in message['data'].decode().split(','):
+                    _local.delete(int(sku_id))
+        except Exception as e:
+            # 订阅期间进程内的缓存无法保证是最新的
+            _local.clear()
+            time.sleep(1)
+
+
+def _ensure_subscriber():
+    global _subscriber_pid
+    if _subscriber_pid == os.getpid():
+        return
+    with _subscriber_lock:
+        if _subscriber_pid == os.getpid():
+            return
+        # 进程内的缓存可能是从父进程继承来的
+        _local.clear()
+        thread = threading.Thread(target=_listen, name='sku-cache-invalidation')
+        thread.daemon = True
+        thread.start()
+        _subscriber_pid = os.getpid()
+
+
+def _sku_key(sku_id):
+    return 'sku_%d' % sku_id
+
+
+def _load_skus(sku_ids):
+    '''从数据库中查询商品，并写入redis缓存'''
+    skus = GoodsSKU.objects.select_related('type', 'goods').in_bulk(sku_ids)
+    if skus:
+        cache.set_many({_sku_key(sku_id): sku for sku_id, sku in skus.items()}, settings.SKU_CACHE_TIMEOUT)
+    return skus
+
+
+def get_skus(sku_ids, fresh=False):
+    '''
+    批量获取商品，返回{sku_id: GoodsSKU}, 不存在的商品不在返回值中
+    fresh: 跳过缓存直接从数据库中查询, 需要最新库存的地方使用
+    返回的对象是缓存对象的副本，调用者可以给对象增加属性
+    '''
+    sku_ids = {int(sku_id) for sku_id in sku_ids}
+    _ensure_subscriber()
+
+    if fresh:
+        skus = _load_skus(sku_ids)
+    else:
+        skus = {}
+        for sku_id in sku_ids:
+            sku = _local.get(sku_id)
+            if sku is not None:
+                skus[sku_id] = sku
+
+        # 进程内没有的从redis中获取
+        missing = [sku_id for sku_id in sku_ids if sku_id not in skus]
+        if missing:
+            cached = cache.get_many([_sku_key(sku_id) for sku_id in missing])
+            for sku_id in missing:
+                sku = cached.get(_sku_key(sku_id))
+                if sku is not None:
+                    skus[sku_id] = sku
+
+        # redis中也没有的从数据库中查询, 只需要一次查询
+        missing = [sku_id for sku_id in sku_ids if sku_id not in skus]
+        if missing:
+            skus.update(_load_skus(missing))
+
+    for sku_id, sku in skus.items():
+        _local.set(sku_id, sku)
+    return {sku_id: copy.copy(sku) for sku_id, sku in skus.items()}
+
+
+def get_sku(sku_id, fresh=False):
+    '''获取一个商品, 商品不存在时抛出GoodsSKU.DoesNotExist'''
+    try:
+        sku_id = int(sku_id)
+    except (TypeError, ValueError):
+        raise GoodsSKU.DoesNotExist
+    sku = get_skus([sku_id], fresh).get(sku_id)
+    if sku is None:
+        raise GoodsSKU.DoesNotExist
+    return sku
+
+
+def invalidate_skus(sku_ids):
+    '''商品变化后删除redis缓存，并通知所有进程删除进程内的缓存'''
+    sku_ids = [int(sku_id) for sku_id in sku_ids]
+    if not sku_ids:
+        return
+    cache.delete_many([_sku_key(sku_id) for sku_id in sku_ids])
+    for sku_id in sku_ids:
+        _local.delete(sku_id)
+    conn = get_redis_connection('default')
+    conn.publish(SKU_INVALIDATE_CHANNEL, ','.join(str(sku_id) for sku_id in sku_ids))
+
+
+def warm_skus(sku_ids):
+    '''把商品从数据库加载到redis缓存中，返回加载的数目'''
+    return len(_load_skus(sku_ids))
+
+
+def sku_changed(sender, instance, **kwargs):
+    '''商品保存或删除时的信号处理函数'''
+    invalidate_skus([instance.id])
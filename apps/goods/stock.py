@@ -0,0 +1,114 @@
+# 商品库存在redis中的镜像，购物车校验库存上限时使用，不需要查询数据库
+# sku_stock: {sku_id: 库存}
+# 下单时仍然以数据库中的库存为准，镜像只需要最终一致:
+# 订单提交和后台修改商品时更新，由定时任务用数据库中的库存校正
+from django_redis import get_redis_connection
+from goods.models import GoodsSKU
+
+STOCK_KEY = 'sku_stock'
+# 校正库存时每次写入redis的商品数目
+RECONCILE_CHUNK_SIZE = 1000
+
+# 只修改镜像中已有的库存，镜像中没有的商品下次读取时从数据库加载
+# ARGV: sku_id, 变化量, sku_id, 变化量, ...
+INCR_STOCKS_LUA = '''
+for i = 1, #ARGV, 2 do
+    if redis.call('hexists', KEYS[1], ARGV[i]) == 1 then
+        redis.call('hincrby', KEYS[1], ARGV[i], ARGV[i + 1])
+    end
+end
+return 1
+'''
+
+
+def _hmset(conn, key, stocks):
+    '''兼容不同版本redis-py的hmset参数'''
+    args = []
+    for sku_id, stock in stocks.items():
+        args.extend([sku_id, stock])
+    conn.execute_command('HMSET', key, *args)
+
+
+def get_stocks(sku_ids):
+    '''
+    批量获取商品的库存，镜像中没有的商品从数据库加载后写入镜像
+    返回{sku_id: 库存}，不存在的商品不在结果中
+    '''
+    sku_ids = list({int(sku_id) for sku_id in sku_ids})
+    if not sku_ids:
+        return {}
+
+    conn = get_redis_connection('default')
+    stocks = {}
+    missing = []
+    for sku_id, stock in zip(sku_ids, conn.hmget(STOCK_KEY, sku_ids)):
+        if stock is None:
+            missing.append(sku_id)
+        else:
+            stocks[sku_id] = int(stock)
+
+    if missing:
+        loaded = dict(GoodsSKU.objects.filter(id__in=missing).values_list('id', 'stock'))
+        if loaded:
+            _hmset(conn, STOCK_KEY, loaded)
+        stocks.update(loaded)
+    return stocks
+
+
+def get_stock(sku_id):
+    '''获取一个商品的库存，商品不存在时返回None'''
+    try:
+        sku_id = int(sku_id)
+    except (TypeError, ValueError):
+        return None
+    return get_stocks([sku_id]).get(sku_id)
+
+
+def set_stocks(stocks):
+    '''设置商品的库存, stocks: {sku_id: 库存}'''
+    if stocks:
+        _hmset(get_redis_connection('default'), STOCK_KEY, stocks)
+
+
+def remove_stocks(sku_ids):
+    '''删除商品后从镜像中移除'''
+    if sku_ids:
+        get_redis_connection('default').hdel(STOCK_KEY, *sku_ids)
+
+
+def decr_stocks(sales):
+    '''
+    订单提交后减少镜像中的库存
+    sales: [(type_id, sku_id, count), ...]
+    '''
+    args = []
+    for type_id, sku_id, count in sales:
+        args.extend([sku_id, -int(count)])
+    if args:
+        conn = get_redis_connection('default')
+        conn.register_script(INCR_STOCKS_LUA)(keys=[STOCK_KEY], args=args)
+
+
+def reconcile_stocks():
+    '''用数据库中的库存重建镜像，先写入临时的key，再原子地替换'''
+    conn = get_redis_connection('default')
+    tmp_key = '%s_tmp' % STOCK_KEY
+    conn.delete(tmp_key)
+
+    count = 0
+    chunk = {}
+    for sku_id, stock in GoodsSKU.objects.order_by('id').values_list('id', 'stock').iterator():
+        chunk[sku_id] = stock
+        if len(chunk) >= RECONCILE_CHUNK_SIZE:
+            _hmset(conn, tmp_key, chunk)
+            count += len(chunk)
+            chunk = {}
+    if chunk:
+        _hmset(conn, tmp_key, chunk)
+        count += len(chunk)
+
+    if count:
+        conn.rename(tmp_key, STOCK_KEY)
+    else:
+        conn.delete(STOCK_KEY)
+    return count
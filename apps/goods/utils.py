@@ -0,0 +1,345 @@
+from django.core.cache import cache
+from django_redis import get_redis_connection
+from utils.cache import get_many_or_set, get_or_set, set_entries, acquire_lock
+from utils.pagination import KeysetPage, keyset_paginate, page_range, parse_page, get_num_pages
+from goods.rankings import get_ranking_page
+from goods.models import GoodsType, GoodsSKU, IndexGoodsBanner, IndexPromotionBanner, IndexTypeGoodsBanner
+from order.models import OrderGoods
+import time
+
+# 首页缓存片段的过期时间
+INDEX_FRAGMENT_TIMEOUT = 3600
+
+# 首页缓存片段命中率和重建耗时的统计数据
+INDEX_FRAGMENT_STATS_KEY = 'index_fragment_stats'
+
+# 分类新品推荐的缓存过期时间
+NEW_SKUS_TIMEOUT = 600
+
+# 列表页每页显示的商品数目
+LIST_PAGE_SIZE = 1
+
+# 列表页的排序方式和对应的排序字段, 最后一个字段唯一，用于游标分页
+LIST_SORTS = ('default', 'price', 'hot')
+LIST_ORDERINGS = {
+    'default': ['-id'],
+    'price': ['price', 'id'],
+    'hot': ['-sales', '-id'],
+}
+
+# 提交重建分类排行任务的间隔
+RANKINGS_REBUILD_LOCK_TIMEOUT = 60
+
+# 分类商品数目的缓存过期时间
+TYPE_SKU_COUNT_TIMEOUT = 600
+
+# 首页中固定的缓存片段: 分类导航, 轮播商品, 促销活动
+# 每个分类的展示商品(楼层)单独作为一个片段: type_banners_种类id
+INDEX_FIXED_FRAGMENTS = ('types', 'goods_banners', 'promotion_banners')
+
+
+def type_banners_fragment(type_id):
+    '''返回分类展示商品片段的名称'''
+    return 'type_banners_%d' % int(type_id)
+
+
+def _version_key(name):
+    return 'index_fragment_version_%s' % name
+
+
+def _data_key(name):
+    return 'index_fragment_%s' % name
+
+
+def _new_version():
+    return int(time.time() * 1000000)
+
+
+def get_index_fragment_versions(names):
+    '''获取首页缓存片段的当前版本, 没有版本的片段进行初始化'''
+    keys = {name: _version_key(name) for name in names}
+    versions = cache.get_many(list(keys.values()))
+
+    result = {}
+    for name, key in keys.items():
+        version = versions.get(key)
+        if version is None:
+            # 版本号永不过期，只在数据变化时更新
+            version = _new_version()
+            if not cache.add(key, version, None):
+                # 其他进程已经初始化了版本号
+                version = cache.get(key, version)
+        result[name] = version
+    return result
+
+
+def bump_index_fragments(*names):
+    '''数据变化时更新片段的版本号，旧版本的缓存数据只在重建期间作为旧数据使用'''
+    if not names:
+        return
+    version = _new_version()
+    cache.set_many({_version_key(name): version for name in names}, None)
+
+
+def _record_fragment_stats(hits, stale, costs):
+    '''记录片段的命中次数，使用旧数据的次数，未命中次数和重建耗时(微秒)'''
+    conn = get_redis_connection('default')
+    pipe = conn.pipeline(transaction=False)
+    for name in hits:
+        pipe.hincrby(INDEX_FRAGMENT_STATS_KEY, '%s:hits' % name, 1)
+    for name in stale:
+        pipe.hincrby(INDEX_FRAGMENT_STATS_KEY, '%s:stale' % name, 1)
+    for name, cost in costs.items():
+        pipe.hincrby(INDEX_FRAGMENT_STATS_KEY, '%s:misses' % name, 1)
+        pipe.hincrby(INDEX_FRAGMENT_STATS_KEY, '%s:rebuild_us' % name, cost)
+    pipe.execute()
+
+
+def get_index_fragments(names, build):
+    '''
+    获取首页缓存片段
+    build(missing_names)->{name: value}, 用于重建缓存中没有或者版本已经过期的片段
+    同一个片段只有一个进程重建，其他进程在重建期间继续使用旧版本的数据
+    '''
+    names = list(names)
+    if not names:
+        return {}
+
+    versions = get_index_fragment_versions(names)
+    data_keys = {name: _data_key(name) for name in names}
+    key_names = {key: name for name, key in data_keys.items()}
+
+    def build_keys(keys):
+        # 只重建缓存中没有的片段
+        built = build([key_names[key] for key in keys])
+        return {data_keys[name]: value for name, value in built.items()}
+
+    entries, costs = get_many_or_set(data_keys.values(), build_keys, INDEX_FRAGMENT_TIMEOUT,
+                                     {data_keys[name]: versions[name] for name in names})
+
+    result = {name: entries[data_keys[name]].value for name in names}
+    costs = {key_names[key]: cost for key, cost in costs.items()}
+    hits = [name for name in names if name not in costs]
+    stale = [name for name in hits if entries[data_keys[name]].stale]
+
+    _record_fragment_stats(hits, stale, costs)
+    return result
+
+
+def build_fixed_fragments(names):
+    '''从数据库中查询分类导航, 轮播商品, 促销活动片段'''
+    builders = {
+        # 获取商品的分类信息
+        'types': lambda: list(GoodsType.objects.all()),
+        # 获取首页轮播商品信息
+        'goods_banners': lambda: list(IndexGoodsBanner.objects.all().select_related('sku').order_by('index')),
+        # 获取首页促销活动信息
+        'promotion_banners': lambda: list(IndexPromotionBanner.objects.all().order_by('index')),
+    }
+    return {name: builders[name]() for name in names}
+
+
+def build_type_banners_fragments(names):
+    '''从数据库中查询分类展示商品片段, 多个分类只需要一次查询'''
+    type_ids = [int(name.rsplit('_', 1)[1]) for name in names]
+    floors = {type_id: {'image_banners': [], 'title_banners': []} for type_id in type_ids}
+
+    # 一次查询出所有种类的展示商品，在内存中按照种类和展示类型分组
+    type_banners = IndexTypeGoodsBanner.objects.filter(type_id__in=type_ids).select_related('sku').order_by('index')
+    for banner in type_banners:
+        if banner.display_type == 1:
+            floors[banner.type_id]['image_banners'].append(banner)
+        else:
+            floors[banner.type_id]['title_banners'].append(banner)
+
+    return {type_banners_fragment(type_id): floor for type_id, floor in floors.items()}
+
+
+def _index_page_context(fragments, floors):
+    '''用首页缓存片段组织首页的模板上下文'''
+    types = fragments['types']
+    for type in types: # GoodsType->对象
+        floor = floors[type_banners_fragment(type.id)]
+        # 动态给type对象增加属性，分别保存首页展示的图片商品信息和标题商品信息
+        type.image_banners = floor['image_banners']
+        type.title_banners = floor['title_banners']
+
+    # 组织模板上下文
+    context = {'types': types,
+               'goods_banners': fragments['goods_banners'],
+               'promotion_banners': fragments['promotion_banners']}
+
+    return context
+
+
+def get_index_page_data():
+    '''组织首页的模板上下文, 首页视图和生成首页静态页的任务共用'''
+    fragments = get_index_fragments(INDEX_FIXED_FRAGMENTS, build_fixed_fragments)
+
+    # 获取首页分类商品展示信息
+    floors = get_index_fragments([type_banners_fragment(type.id) for type in fragments['types']],
+                                 build_type_banners_fragments)
+
+    return _index_page_context(fragments, floors)
+
+
+def build_index_page_data():
+    '''不使用缓存，直接从数据库中查询首页的模板上下文'''
+    fragments = build_fixed_fragments(INDEX_FIXED_FRAGMENTS)
+    floors = build_type_banners_fragments([type_banners_fragment(type.id) for type in fragments['types']])
+    return _index_page_context(fragments, floors)
+
+
+def warm_index_fragments(names, build, dry_run=False):
+    '''从数据库重建首页缓存片段并写入缓存，dry_run时只查询不写入，返回片段的数目'''
+    names = list(names)
+    built = build(names)
+    if not dry_run:
+        versions = get_index_fragment_versions(names)
+        set_entries({_data_key(name): value for name, value in built.items()}, INDEX_FRAGMENT_TIMEOUT,
+                    {_data_key(name): versions[name] for name in names})
+    return len(built)
+
+
+def get_types():
+    '''获取商品的分类信息，和首页的分类导航使用同一个缓存片段'''
+    return get_index_fragments(['types'], build_fixed_fragments)['types']
+
+
+def _new_skus_key(type_id):
+    return 'type_new_skus_%d' % int(type_id)
+
+
+def build_new_skus(type_id):
+    '''从数据库中查询分类的新品信息'''
+    return list(GoodsSKU.objects.filter(type_id=type_id).order_by('-create_time')[:2])
+
+
+def get_new_skus(type_id):
+    '''获取分类的新品信息, 详情页和列表页共用'''
+    return get_or_set(_new_skus_key(type_id), lambda: build_new_skus(type_id), NEW_SKUS_TIMEOUT)
+
+
+def warm_new_skus(type_ids, dry_run=False):
+    '''从数据库重建分类的新品信息并写入缓存，dry_run时只查询不写入，返回分类的数目'''
+    built = {_new_skus_key(type_id): build_new_skus(type_id) for type_id in type_ids}
+    if not dry_run:
+        set_entries(built, NEW_SKUS_TIMEOUT)
+    return len(built)
+
+
+def invalidate_new_skus(type_id):
+    '''分类中的商品变化时，清除分类的新品信息缓存'''
+    cache.delete(_new_skus_key(type_id))
+
+
+def _type_sku_count_key(type_id):
+    return 'type_sku_count_%d' % int(type_id)
+
+
+def get_type_sku_count(type_id):
+    '''获取分类的商品数目，列表页计算页码使用'''
+    return get_or_set(_type_sku_count_key(type_id),
+                      lambda: GoodsSKU.objects.filter(type_id=type_id).count(),
+                      TYPE_SKU_COUNT_TIMEOUT)
+
+
+def invalidate_type_sku_count(type_id):
+    '''分类中添加或删除商品时，清除分类商品数目的缓存'''
+    cache.delete(_type_sku_count_key(type_id))
+
+
+def rebuild_rankings_async(type_id):
+    '''在后台重建分类排行，同一个分类同一时间只提交一个重建任务'''
+    if acquire_lock('type_rank_%d' % int(type_id), RANKINGS_REBUILD_LOCK_TIMEOUT) is not None:
+        from celery_tasks.tasks import rebuild_sku_rankings
+        rebuild_sku_rankings.delay(type_id)
+
+
+def get_detail_context(sku):
+    '''组织详情页的模板上下文，详情页视图和生成详情页静态页的任务共用'''
+    # 获取商品分类信息
+    types = get_types()
+
+    # 获取商品评论信息
+    sku_orders = OrderGoods.objects.filter(sku=sku).exclude(comment='')[:30]
+
+    # 获取新品信息
+    new_skus = get_new_skus(sku.type_id)
+
+    # 获取商品的其他规格
+    same_spu_skus = GoodsSKU.objects.filter(goods_id=sku.goods_id).exclude(id=sku.id)
+
+    # 组织模板上下文
+    context = {'sku':sku, 'types':types,
+               'sku_orders':sku_orders,
+               'new_skus':new_skus,
+               'same_spu_skus': same_spu_skus}
+
+    return context
+
+
+def get_list_context(type, page, sort, after=None, before=None):
+    '''组织列表页的模板上下文，列表页视图和生成列表页静态页的任务共用'''
+    # 获取商品分类信息
+    types = get_types()
+
+    # 获取分类商品的信息
+    # sort=default->默认排序方式
+    # sort=price->按照价格排序
+    # sort=hot->按照商品的销量进行排序
+    if sort not in LIST_ORDERINGS:
+        sort = 'default'
+
+    # 对数据进行分页, 优先从redis的分类排行中获取当前页的商品id
+    ranking = get_ranking_page(type.id, sort, parse_page(page), LIST_PAGE_SIZE)
+    if ranking is not None:
+        sku_ids, count, page = ranking
+        # 只查询当前页的商品
+        skus = GoodsSKU.objects.in_bulk(sku_ids)
+        skus_page = KeysetPage([skus[sku_id] for sku_id in sku_ids if sku_id in skus], page,
+                               get_num_pages(count, LIST_PAGE_SIZE), LIST_ORDERINGS[sort])
+    else:
+        # 排行不存在时从数据库查询, 并在后台重建排行
+        rebuild_rankings_async(type.id)
+
+        # 总数目从缓存中获取，前后翻页使用游标
+        skus = GoodsSKU.objects.filter(type=type)
+        skus_page = keyset_paginate(skus, LIST_ORDERINGS[sort], page, LIST_PAGE_SIZE,
+                                    get_type_sku_count(type.id), after, before)
+    pages = page_range(skus_page.num_pages, skus_page.number)
+
+    # 获取新品信息
+    new_skus = get_new_skus(type.id)
+
+    # 组织模板上下文
+    context = {'type':type, 'types':types,
+               'skus_page':skus_page,
+               'new_skus':new_skus,
+               'pages':pages,
+               'sort':sort}
+
+    return context
+
+
+def get_index_fragment_stats():
+    '''返回每个首页缓存片段的命中率和平均重建耗时'''
+    conn = get_redis_connection('default')
+    raw = conn.hgetall(INDEX_FRAGMENT_STATS_KEY)
+
+    stats = {}
+    for field, value in raw.items():
+        name, metric = field.decode().rsplit(':', 1)
+        stats.setdefault(name, {'hits': 0, 'stale': 0, 'misses': 0, 'rebuild_us': 0})[metric] = int(value)
+
+    for item in stats.values():
+        total = item['hits'] + item['misses']
+        item['hit_ratio'] = item['hits'] / total if total else 0
+        item['avg_rebuild_ms'] = item['rebuild_us'] / item['misses'] / 1000 if item['misses'] else 0
+    return stats
+
+
+def reset_index_fragment_stats():
+    '''清空首页缓存片段的统计数据'''
+    conn = get_redis_connection('default')
+    conn.delete(INDEX_FRAGMENT_STATS_KEY)
@@ -0,0 +1,248 @@
+# 订单创建: 悲观锁和乐观锁两种策略
+# 同步下单时由视图调用，异步下单时由celery worker调用
+from django.db import transaction
+from django_redis import get_redis_connection
+from goods.models import GoodsSKU
+from goods.sku_cache import invalidate_skus
+from goods.rankings import incr_sku_sales
+from goods.stock import decr_stocks
+from order.models import OrderInfo, OrderGoods
+from order.utils import invalidate_user_order_count, update_sku_stocks, record_order_commit
+from order.order_id import new_order_id
+from cart.utils import delete_from_cart
+from utils.redis_router import get_user_connection
+from collections import OrderedDict
+import json
+import time
+import uuid
+
+# 异步下单的票据: order_ticket_票据 {'user_id': 用户id, 'result': 订单创建的应答, 处理中为None}
+# order_ticket_done_票据: 订单处理完成时放入一个元素，查询结果的请求用BLPOP等待
+ORDER_TICKET_TIMEOUT = 3600
+# 查询结果时最多等待的秒数
+ORDER_STATUS_MAX_WAIT = 10
+
+
+def _order_lines(skus, sku_ids, counts):
+    '''
+    校验商品的库存，计算订单中商品的总数目和总金额
+    返回(错误应答或者None, 总数目, 总金额, [(sku, count), ...], [(type_id, sku_id, count), ...])
+    '''
+    # 总金额和总数目
+    total_count = 0
+    total_price = 0
+    # 商品的销量变化: [(type_id, sku_id, count), ...]
+    sales = []
+    order_skus = []
+    for sku_id, count in zip(sku_ids, counts):
+        sku = skus[int(sku_id)]
+        # 判断商品的库存
+        if count > sku.stock:
+            return {'res':6, 'errmsg':'商品库存不足'}, 0, 0, [], []
+
+        order_skus.append((sku, count))
+        sales.append((sku.type_id, sku.id, count))
+
+        # todo: 累加计算订单中商品的总数目和总金额
+        total_count += count
+        total_price += sku.price*count
+    return None, total_count, total_price, order_skus, sales
+
+
+def _create_order(order_id, user, addr, pay_method, total_count, total_price, order_skus):
+    # 运费
+    transit_price = 10
+
+    # todo: 向订单信息表中添加一条记录
+    order = OrderInfo.objects.create(order_id=order_id,
+                                     user=user,
+                                     addr=addr,
+                                     pay_method=pay_method,
+                                     total_count=total_count,
+                                     total_price=total_price,
+                                     transit_price=transit_price)
+
+    # todo: 一次向订单商品表中添加全部记录
+    OrderGoods.objects.bulk_create([OrderGoods(order=order,
+                                               sku=sku,
+                                               count=count,
+                                               price=sku.price) for sku, count in order_skus])
+
+
+@transaction.atomic
+def _commit_pessimistic(order_id, user, addr, pay_method, sku_ids, counts):
+    '''悲观锁: 按照id的顺序锁定全部商品，返回(应答, 商品的销量变化)'''
+    # todo: 设置保存点
+    save_id = transaction.savepoint()
+
+    lock_wait = 0
+    try:
+        # 一条语句按照id的顺序锁定全部商品，并发的订单加锁的顺序一致，不会死锁
+        # select * from df_goods_sku where id in (5,6) order by id for update;
+        start = time.time()
+        skus = {sku.id: sku for sku in GoodsSKU.objects.select_for_update().filter(id__in=sku_ids).order_by('id')}
+        lock_wait = time.time() - start
+        if len(skus) != len(sku_ids):
+            # 商品不存在
+            transaction.savepoint_rollback(save_id)
+            return {'res':4, 'errmsg':'商品不存在'}, []
+
+        error, total_count, total_price, order_skus, sales = _order_lines(skus, sku_ids, counts)
+        if error is not None:
+            transaction.savepoint_rollback(save_id)
+            record_order_commit('pessimistic', lock_wait, False)
+            return error, []
+
+        # todo: 更新对应商品的库存和销量, 商品已经锁定，库存不会变化
+        update_sku_stocks(sales)
+
+        _create_order(order_id, user, addr, pay_method, total_count, total_price, order_skus)
+    except Exception as e:
+        # 事务回滚
+        transaction.savepoint_rollback(save_id)
+        record_order_commit('pessimistic', lock_wait, False)
+        return {'res':7, 'errmsg':'下单失败'}, []
+
+    # todo: 事务提交
+    transaction.savepoint_commit(save_id)
+    record_order_commit('pessimistic', lock_wait, True)
+    return {'res':5, 'message':'订单创建成功'}, sales
+
+
+@transaction.atomic
+def _commit_optimistic(order_id, user, addr, pay_method, sku_ids, counts):
+    '''乐观锁: 不锁定商品，用条件update减少库存，返回(应答, 商品的销量变化)'''
+    # todo: 设置保存点
+    save_id = transaction.savepoint()
+
+    lock_wait = 0
+    try:
+        # 一次查询全部商品的信息
+        skus = GoodsSKU.objects.in_bulk(sku_ids)
+        if len(skus) != len(sku_ids):
+            # 商品不存在
+            transaction.savepoint_rollback(save_id)
+            return {'res':4, 'errmsg':'商品不存在'}, []
+
+        error, total_count, total_price, order_skus, sales = _order_lines(skus, sku_ids, counts)
+        if error is not None:
+            transaction.savepoint_rollback(save_id)
+            return error, []
+
+        # todo: 一条update语句更新全部商品的库存和销量, 只更新库存足够的商品, 不需要重试
+        # 等待其他订单释放行锁的时间包含在update的时间中
+        start = time.time()
+        res = update_sku_stocks(sales)
+        lock_wait = time.time() - start
+        if res != len(sales):
+            # 有商品在查询之后被其他订单买走，库存不足
+            transaction.savepoint_rollback(save_id)
+            record_order_commit('optimistic', lock_wait, False)
+            return {'res':6, 'errmsg':'商品库存不足'}, []
+
+        _create_order(order_id, user, addr, pay_method, total_count, total_price, order_skus)
+    except Exception as e:
+        # 事务回滚
+        transaction.savepoint_rollback(save_id)
+        record_order_commit('optimistic', lock_wait, False)
+        return {'res':7, 'errmsg':'下单失败'}, []
+
+    # todo: 事务提交
+    transaction.savepoint_commit(save_id)
+    record_order_commit('optimistic', lock_wait, True)
+    return {'res':5, 'message':'订单创建成功'}, sales
+
+
+COMMIT_STRATEGIES = {
+    'pessimistic': _commit_pessimistic,
+    'optimistic': _commit_optimistic,
+}
+
+
+def commit_order(user, addr, pay_method, sku_ids, strategy):
+    '''
+    创建订单，参数已经由调用者校验
+    sku_ids: 用户要购买的商品id的列表，购买的数量从购物车中获取
+    strategy: optimistic或者pessimistic
+    返回应答的数据 {'res': 5, 'order_id': 订单id, 'message': ...} 或者 {'res': 错误码, 'errmsg': ...}
+    '''
+    # 组织订单数据
+    # 订单id: 格式:20171122122930+毫秒+机器号+序号
+    order_id = new_order_id()
+
+    # todo: 向订单商品表中添加信息时，用户买了几件商品，需要添加几条记录
+    # 去掉重复的商品id, 保持原来的顺序
+    sku_ids = list(OrderedDict.fromkeys(sku_ids)) # [5,6]
+
+    # 从redis中一次获取用户要购买的全部商品的数量
+    conn = get_user_connection(user.id)
+    cart_key = 'cart_%d'%user.id
+    try:
+        counts = [int(count) for count in conn.hmget(cart_key, sku_ids)]
+    except (TypeError, ValueError) as e:
+        # 商品不在购物车中
+        return {'res':7, 'errmsg':'下单失败'}
+
+    result, sales = COMMIT_STRATEGIES[strategy](order_id, user, addr, pay_method, sku_ids, counts)
+    if result['res'] != 5:
+        return result
+
+    # 事务已经提交
+    # 用户的订单数目变化
+    invalidate_user_order_count(user.id)
+
+    # 更新分类的销量排行
+    incr_sku_sales(sales)
+
+    # 商品的库存和销量变化, 清除商品缓存
+    invalidate_skus([sku_id for type_id, sku_id, count in sales])
+    decr_stocks(sales)
+
+    # todo: 删除用户购物车中的相应记录, 同时更新购物车中商品的总件数
+    delete_from_cart(user.id, *sku_ids)
+
+    result['order_id'] = order_id
+    return result
+
+
+def _ticket_key(ticket):
+    return 'order_ticket_%s' % ticket
+
+
+def _ticket_done_key(ticket):
+    return 'order_ticket_done_%s' % ticket
+
+
+def create_order_ticket(user_id, ticket=None):
+    '''创建异步下单的票据，秒杀商品的订单使用订单id作为票据'''
+    ticket = ticket or uuid.uuid4().hex
+    conn = get_redis_connection('default')
+    conn.set(_ticket_key(ticket), json.dumps({'user_id': user_id, 'result': None}), ex=ORDER_TICKET_TIMEOUT)
+    return ticket
+
+
+def finish_order_ticket(ticket, user_id, result):
+    '''保存订单创建的应答，唤醒等待结果的请求'''
+    conn = get_redis_connection('default')
+    pipe = conn.pipeline()
+    pipe.set(_ticket_key(ticket), json.dumps({'user_id': user_id, 'result': result}), ex=ORDER_TICKET_TIMEOUT)
+    pipe.rpush(_ticket_done_key(ticket), 1)
+    pipe.expire(_ticket_done_key(ticket), ORDER_STATUS_MAX_WAIT * 2)
+    pipe.execute()
+
+
+def get_order_ticket(ticket, wait=0):
+    '''
+    查询异步下单的结果，订单还在处理时最多等待wait秒
+    返回{'user_id': 用户id, 'result': 应答或者None}，票据不存在时返回None
+    '''
+    conn = get_redis_connection('default')
+    status = conn.get(_ticket_key(ticket))
+    if status is None:
+        return None
+    status = json.loads(status.decode())
+    if status['result'] is None and wait:
+        # 处理完成之后再读取一次结果
+        if conn.blpop(_ticket_done_key(ticket), wait) is not None:
+            status = json.loads(conn.get(_ticket_key(ticket)).decode())
+    return status
@@ -0,0 +1,329 @@
+# 秒杀商品的下单: 库存预先加载到redis中，下单时在redis中原子地预留库存，
+# 数据库中的订单，订单商品和商品的库存销量由celery worker批量结算，不在下单请求中竞争商品的行锁
+# flash_stock: {sku_id: 剩余库存} 只包含开启秒杀的商品
+# flash_reservations: {order_id: 订单数据json} 还没有结算的预留
+# flash_deadlines: {order_id: 预留的过期时间} 按照时间顺序结算，超时没有结算的预留由reap_expired_reservations退回库存
+# flash_settling: {order_id: 结算的截止时间} 正在结算的预留，事务提交之后才从flash_reservations中删除;
+# 结算的进程退出或者数据库暂时不可用时留下的预留由reap_expired_reservations放回flash_deadlines重新结算
+# 订单id同时是下单的票据(order.commit)，结算成功或者失败之后记录结果，前端查询/order/status获取
+from django.conf import settings
+from django.db import transaction, IntegrityError
+from django_redis import get_redis_connection
+from goods.models import GoodsSKU
+from goods.sku_cache import invalidate_skus
+from goods.rankings import incr_sku_sales
+from goods.stock import decr_stocks
+from order.models import OrderInfo, OrderGoods
+from order.utils import update_sku_stocks, invalidate_user_order_count
+from order.commit import finish_order_ticket
+from decimal import Decimal
+import json
+import time
+
+FLASH_STOCK_KEY = 'flash_stock'
+FLASH_RESERVATIONS_KEY = 'flash_reservations'
+FLASH_DEADLINES_KEY = 'flash_deadlines'
+FLASH_SETTLING_KEY = 'flash_settling'
+# 已经安排了结算任务，防止每个订单都发送一个任务
+FLASH_SETTLE_SCHEDULED_KEY = 'flash_settle_scheduled'
+FLASH_SETTLE_SCHEDULED_TIMEOUT = 5
+
+# 退回一个预留的库存，商品已经关闭秒杀时不退回
+RESTORE_LUA = '''
+local function restore(payload)
+    local data = cjson.decode(payload)
+    for _, line in ipairs(data['lines']) do
+        if redis.call('hexists', KEYS[1], line[1]) == 1 then
+            redis.call('hincrby', KEYS[1], line[1], line[2])
+        end
+    end
+end
+'''
+
+# 预留库存
+# KEYS: flash_stock, flash_reservations, flash_deadlines
+# ARGV: order_id, 过期时间, 订单数据json, sku_id, count, sku_id, count, ...
+# 返回1成功, 0库存不足, -1商品没有开启秒杀, -2订单id重复
+RESERVE_LUA = '''
+for i = 4, #ARGV, 2 do
+    local stock = redis.call('hget', KEYS[1], ARGV[i])
+    if not stock then
+        return -1
+    end
+    if tonumber(stock) < tonumber(ARGV[i + 1]) then
+        return 0
+    end
+end
+if redis.call('hexists', KEYS[2], ARGV[1]) == 1 then
+    return -2
+end
+for i = 4, #ARGV, 2 do
+    redis.call('hincrby', KEYS[1], ARGV[i], -tonumber(ARGV[i + 1]))
+end
+redis.call('hset', KEYS[2], ARGV[1], ARGV[3])
+redis.call('zadd', KEYS[3], ARGV[2], ARGV[1])
+return 1
+'''
+
+# 取出最早的limit个预留用来结算，放入flash_settling，预留的数据保留到事务提交之后
+# KEYS: flash_stock, flash_reservations, flash_deadlines, flash_settling  ARGV: limit, 结算的截止时间
+CLAIM_LUA = '''
+local result = {}
+for _, order_id in ipairs(redis.call('zrange', KEYS[3], 0, tonumber(ARGV[1]) - 1)) do
+    redis.call('zrem', KEYS[3], order_id)
+    local payload = redis.call('hget', KEYS[2], order_id)
+    if payload then
+        redis.call('zadd', KEYS[4], ARGV[2], order_id)
+        table.insert(result, payload)
+    end
+end
+return result
+'''
+
+# 结算完成，删除预留
+# KEYS: flash_stock, flash_reservations, flash_deadlines, flash_settling  ARGV: order_id, ...
+FINISH_LUA = '''
+for _, order_id in ipairs(ARGV) do
+    redis.call('zrem', KEYS[4], order_id)
+    redis.call('hdel', KEYS[2], order_id)
+end
+return #ARGV
+'''
+
+# 退回已经过期的预留的库存，结算超时的预留放回flash_deadlines重新结算
+# KEYS: flash_stock, flash_reservations, flash_deadlines, flash_settling
+# ARGV: 当前时间, limit
+# 返回{重新结算的数目, 退回的订单数据json, ...}
+REAP_LUA = RESTORE_LUA + '''
+local released = {}
+for _, order_id in ipairs(redis.call('zrangebyscore', KEYS[3], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))) do
+    redis.call('zrem', KEYS[3], order_id)
+    local payload = redis.call('hget', KEYS[2], order_id)
+    redis.call('hdel', KEYS[2], order_id)
+    if payload then
+        restore(payload)
+        table.insert(released, payload)
+    end
+end
+-- 数据库中可能已经有订单，不能按照过期时间退回库存，由结算任务检查数据库之后结算或者退回
+local requeued = 0
+for _, order_id in ipairs(redis.call('zrangebyscore', KEYS[4], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))) do
+    redis.call('zrem', KEYS[4], order_id)
+    if redis.call('hexists', KEYS[2], order_id) == 1 then
+        redis.call('zadd', KEYS[3], '+inf', order_id)
+        requeued = requeued + 1
+    end
+end
+table.insert(released, 1, requeued)
+return released
+'''
+
+# 退回结算失败的预留的库存
+# KEYS: flash_stock, flash_reservations, flash_deadlines, flash_settling  ARGV: order_id, ...
+RELEASE_LUA = RESTORE_LUA + '''
+local count = 0
+for _, order_id in ipairs(ARGV) do
+    local payload = redis.call('hget', KEYS[2], order_id)
+    redis.call('zrem', KEYS[4], order_id)
+    redis.call('hdel', KEYS[2], order_id)
+    if payload then
+        restore(payload)
+        count = count + 1
+    end
+end
+return count
+'''
+
+_KEYS = [FLASH_STOCK_KEY, FLASH_RESERVATIONS_KEY, FLASH_DEADLINES_KEY, FLASH_SETTLING_KEY]
+
+
+# 结算成功时记录的应答
+SETTLED_RESULT = {'res':5, 'message':'订单创建成功'}
+
+
+class SettleError(Exception):
+    '''数据库中的库存不足，订单不能结算'''
+    pass
+
+
+def enable_flash_sale(sku_ids):
+    '''开启商品的秒杀，从数据库加载库存，返回{sku_id: 库存}'''
+    stocks = dict(GoodsSKU.objects.filter(id__in=sku_ids).values_list('id', 'stock'))
+    if stocks:
+        args = []
+        for sku_id, stock in stocks.items():
+            args.extend([sku_id, stock])
+        get_redis_connection('default').execute_command('HMSET', FLASH_STOCK_KEY, *args)
+    return stocks
+
+
+def disable_flash_sale(sku_ids):
+    '''关闭商品的秒杀，已经预留的订单仍然会结算'''
+    if sku_ids:
+        get_redis_connection('default').hdel(FLASH_STOCK_KEY, *sku_ids)
+
+
+def get_flash_stocks():
+    '''返回开启秒杀的商品的剩余库存{sku_id: 库存}'''
+    conn = get_redis_connection('default')
+    return {int(sku_id): int(stock) for sku_id, stock in conn.hgetall(FLASH_STOCK_KEY).items()}
+
+
+def get_flash_sku_ids(sku_ids):
+    '''返回sku_ids中开启秒杀的商品id'''
+    sku_ids = list(sku_ids)
+    if not sku_ids:
+        return set()
+    conn = get_redis_connection('default')
+    stocks = conn.hmget(FLASH_STOCK_KEY, sku_ids)
+    return {sku_id for sku_id, stock in zip(sku_ids, stocks) if stock is not None}
+
+
+def reserve_flash_order(order):
+    '''
+    在redis中预留秒杀商品的库存
+    order: {'order_id', 'user_id', 'addr_id', 'pay_method', 'transit_price',
+            'lines': [[sku_id, count, price, type_id], ...]}
+    返回1成功, 0库存不足, -1商品没有开启秒杀, -2订单id重复
+    '''
+    args = [order['order_id'], time.time() + settings.FLASH_RESERVATION_TIMEOUT, json.dumps(order)]
+    for sku_id, count, price, type_id in order['lines']:
+        args.extend([sku_id, count])
+    conn = get_redis_connection('default')
+    return conn.register_script(RESERVE_LUA)(keys=_KEYS[:3], args=args)
+
+
+def schedule_settlement():
+    '''安排结算任务，已经安排的任务还没有开始执行时不重复发送'''
+    conn = get_redis_connection('default')
+    if conn.set(FLASH_SETTLE_SCHEDULED_KEY, 1, nx=True, ex=FLASH_SETTLE_SCHEDULED_TIMEOUT):
+        from celery_tasks.tasks import settle_flash_orders
+        settle_flash_orders.delay()
+
+
+def _settle(orders):
+    '''在数据库中创建订单和订单商品，更新商品的库存和销量'''
+    # 同一个商品在一批订单中的数目合并成一次更新
+    counts = {}
+    for order in orders:
+        for sku_id, count, price, type_id in order['lines']:
+            key = (type_id, int(sku_id))
+            counts[key] = counts.get(key, 0) + count
+    sales = [(type_id, sku_id, count) for (type_id, sku_id), count in counts.items()]
+
+    with transaction.atomic():
+        if update_sku_stocks(sales) != len(sales):
+            raise SettleError()
+
+        OrderInfo.objects.bulk_create([OrderInfo(order_id=order['order_id'],
+                                                 user_id=order['user_id'],
+                                                 addr_id=order['addr_id'],
+                                                 pay_method=order['pay_method'],
+                                                 total_count=sum(line[1] for line in order['lines']),
+                                                 total_price=sum(line[1] * Decimal(line[2]) for line in order['lines']),
+                                                 transit_price=Decimal(order['transit_price']))
+                                       for order in orders])
+        OrderGoods.objects.bulk_create([OrderGoods(order_id=order['order_id'],
+                                                   sku_id=int(sku_id),
+                                                   count=count,
+                                                   price=Decimal(price))
+                                        for order in orders for sku_id, count, price, type_id in order['lines']])
+    return sales
+
+
+def _existing_order_ids(order_ids):
+    '''数据库中已经创建的订单id'''
+    return set(OrderInfo.objects.filter(order_id__in=order_ids).values_list('order_id', flat=True))
+
+
+def _finish_orders(orders, result):
+    '''记录订单结算的结果，result中的order_id使用每个订单的id'''
+    for order in orders:
+        finish_order_ticket(order['order_id'], order['user_id'], dict(result, order_id=order['order_id']))
+
+
+def settle_reservations(batch_size=None):
+    '''
+    批量结算预留的订单，一批订单在一个事务中结算
+    一批结算失败时逐个结算，库存不足或者数据冲突的订单退回redis中的库存;
+    其他错误(死锁，锁等待超时，连接断开)的订单留在flash_settling中，由reap_expired_reservations放回重新结算
+    事务提交之后才删除redis中的预留，重新结算时跳过数据库中已经创建的订单
+    返回(结算的订单数目, 失败的订单数目)
+    '''
+    batch_size = batch_size or settings.FLASH_SETTLE_BATCH_SIZE
+    conn = get_redis_connection('default')
+    # 开始结算之后的新订单需要重新安排任务
+    conn.delete(FLASH_SETTLE_SCHEDULED_KEY)
+
+    settled = failed = 0
+    while True:
+        payloads = conn.register_script(CLAIM_LUA)(keys=_KEYS, args=[batch_size,
+                                                                    time.time() + settings.FLASH_SETTLE_TIMEOUT])
+        if not payloads:
+            break
+        orders = [json.loads(payload.decode() if isinstance(payload, bytes) else payload) for payload in payloads]
+
+        # 上一次结算的事务已经提交，但是没有删除预留
+        existing = _existing_order_ids([order['order_id'] for order in orders])
+        if existing:
+            conn.register_script(FINISH_LUA)(keys=_KEYS, args=list(existing))
+            _finish_orders([order for order in orders if order['order_id'] in existing], SETTLED_RESULT)
+            orders = [order for order in orders if order['order_id'] not in existing]
+        if not orders:
+            continue
+
+        # {order_id: 应答}
+        failed_orders = {}
+        try:
+            done = [(orders, _settle(orders))]
+        except Exception as e:
+            done = []
+            for order in orders:
+                try:
+                    done.append(([order], _settle([order])))
+                except SettleError as e:
+                    failed_orders[order['order_id']] = (order, {'res':6, 'errmsg':'商品库存不足'})
+                except IntegrityError as e:
+                    failed_orders[order['order_id']] = (order, {'res':7, 'errmsg':'下单失败'})
+                except Exception as e:
+                    # 暂时的错误，不退回库存，超过FLASH_SETTLE_TIMEOUT之后重新结算
+                    pass
+
+        if failed_orders:
+            # 另一个进程可能同时结算了同一个超时放回的订单，已经创建的订单不退回库存
+            existing = _existing_order_ids(list(failed_orders))
+            if existing:
+                conn.register_script(FINISH_LUA)(keys=_KEYS, args=list(existing))
+                _finish_orders([failed_orders.pop(order_id)[0] for order_id in existing], SETTLED_RESULT)
+        if failed_orders:
+            conn.register_script(RELEASE_LUA)(keys=_KEYS, args=list(failed_orders))
+            failed += len(failed_orders)
+            for order, result in failed_orders.values():
+                _finish_orders([order], result)
+
+        for settled_orders, sales in done:
+            conn.register_script(FINISH_LUA)(keys=_KEYS, args=[order['order_id'] for order in settled_orders])
+            _finish_orders(settled_orders, SETTLED_RESULT)
+            settled += len(settled_orders)
+            for user_id in {order['user_id'] for order in settled_orders}:
+                invalidate_user_order_count(user_id)
+            incr_sku_sales(sales)
+            invalidate_skus([sku_id for type_id, sku_id, count in sales])
+            decr_stocks(sales)
+    return settled, failed
+
+
+def reap_expired_reservations(limit=1000):
+    '''
+    超过FLASH_RESERVATION_TIMEOUT还没有结算的预留退回库存
+    超过FLASH_SETTLE_TIMEOUT还没有结算完成的预留放回flash_deadlines，安排重新结算，不再按照过期时间退回
+    返回(退回的数目, 重新结算的数目)
+    '''
+    conn = get_redis_connection('default')
+    result = conn.register_script(REAP_LUA)(keys=_KEYS, args=[time.time(), limit])
+    requeued, payloads = result[0], result[1:]
+    _finish_orders([json.loads(payload.decode() if isinstance(payload, bytes) else payload) for payload in payloads],
+                   {'res':7, 'errmsg':'下单失败'})
+    if requeued:
+        schedule_settlement()
+    return len(payloads), requeued
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+from utils.admission import enable_admission, disable_admission, get_admission_status
+
+ACTIONS = ('enable', 'disable', 'status')
+
+
+class Command(BaseCommand):
+    '''开启或者关闭商品的准入控制，查看排队的人数'''
+    help = '开启或者关闭商品的准入控制，查看排队的人数'
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', help='操作: %s' % ', '.join(ACTIONS))
+        parser.add_argument('sku_ids', nargs='*', type=int, help='enable/disable的商品id')
+
+    def handle(self, *args, **options):
+        action = options['action']
+        sku_ids = options['sku_ids']
+        if action not in ACTIONS:
+            raise CommandError('未知的操作: %s' % action)
+        if action in ('enable', 'disable') and not sku_ids:
+            raise CommandError('需要指定商品id')
+
+        if action == 'enable':
+            enable_admission(sku_ids)
+            self.stdout.write('已开启准入控制: %s' % ', '.join(str(sku_id) for sku_id in sku_ids))
+        elif action == 'disable':
+            disable_admission(sku_ids)
+            self.stdout.write('已关闭准入控制: %s' % ', '.join(str(sku_id) for sku_id in sku_ids))
+        else:
+            self.stdout.write('%-10s %10s' % ('sku', 'waiting'))
+            for sku_id, waiting in sorted(get_admission_status().items()):
+                self.stdout.write('%-10d %10d' % (sku_id, waiting))
@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand, CommandError
+from django_redis import get_redis_connection
+from order.flash_sale import enable_flash_sale, disable_flash_sale, get_flash_stocks
+from order.flash_sale import settle_reservations, reap_expired_reservations
+from order.flash_sale import FLASH_DEADLINES_KEY, FLASH_SETTLING_KEY
+
+ACTIONS = ('enable', 'disable', 'status', 'settle', 'reap')
+
+
+class Command(BaseCommand):
+    '''开启或者关闭商品的秒杀，查看秒杀商品的库存和没有结算的订单'''
+    help = '开启或者关闭商品的秒杀，查看秒杀商品的库存和没有结算的订单'
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', help='操作: %s' % ', '.join(ACTIONS))
+        parser.add_argument('sku_ids', nargs='*', type=int, help='enable/disable的商品id')
+
+    def handle(self, *args, **options):
+        action = options['action']
+        sku_ids = options['sku_ids']
+        if action not in ACTIONS:
+            raise CommandError('未知的操作: %s' % action)
+        if action in ('enable', 'disable') and not sku_ids:
+            raise CommandError('需要指定商品id')
+
+        if action == 'enable':
+            stocks = enable_flash_sale(sku_ids)
+            missing = [sku_id for sku_id in sku_ids if sku_id not in stocks]
+            for sku_id, stock in sorted(stocks.items()):
+                self.stdout.write('sku %d 开启秒杀，库存%d' % (sku_id, stock))
+            if missing:
+                raise CommandError('商品不存在: %s' % ', '.join(str(sku_id) for sku_id in missing))
+        elif action == 'disable':
+            disable_flash_sale(sku_ids)
+            self.stdout.write('已关闭秒杀: %s' % ', '.join(str(sku_id) for sku_id in sku_ids))
+        elif action == 'settle':
+            settled, failed = settle_reservations()
+            self.stdout.write('结算%d个订单，失败%d个' % (settled, failed))
+        elif action == 'reap':
+            reaped, requeued = reap_expired_reservations()
+            self.stdout.write('退回%d个超时的预留，重新结算%d个' % (reaped, requeued))
+        else:
+            self.stdout.write('%-10s %10s' % ('sku', 'stock'))
+            for sku_id, stock in sorted(get_flash_stocks().items()):
+                self.stdout.write('%-10d %10d' % (sku_id, stock))
+            conn = get_redis_connection('default')
+            self.stdout.write('没有结算的订单: %d' % conn.zcard(FLASH_DEADLINES_KEY))
+            self.stdout.write('正在结算的订单: %d' % conn.zcard(FLASH_SETTLING_KEY))
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from order.utils import get_order_commit_stats, reset_order_commit_stats
+
+
+class Command(BaseCommand):
+    '''显示每种订单创建策略的成功，失败数目和平均等待行锁的时间'''
+    help = '显示每种订单创建策略的成功，失败数目和平均等待行锁的时间'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='显示后清空统计数据')
+
+    def handle(self, *args, **options):
+        stats = get_order_commit_stats()
+
+        self.stdout.write('%-14s %10s %10s %18s' % ('strategy', 'commits', 'failed', 'avg_lock_wait_ms'))
+        for strategy in sorted(stats):
+            item = stats[strategy]
+            self.stdout.write('%-14s %10d %10d %18.2f' % (strategy, item['commits'], item['failed'],
+                                                        item['avg_lock_wait_ms']))
+
+        if options['reset']:
+            reset_order_commit_stats()
+            self.stdout.write('统计数据已清空')
@@ -0,0 +1,148 @@
+# 订单id的生成: 时间 + 机器号 + 序号，不访问数据库
+# 格式: 年月日时分秒(14位) + 毫秒(3位) + 机器号(4位) + 序号(4位)，例如2017112212293012300010000
+# 保留原来的日期前缀，同一个时刻不同进程的机器号不同，同一个进程同一毫秒内的序号不同
+# 机器号从redis中租用: order_worker_机器号 = 持有者，过期之前续租，fork之后子进程重新租用
+from django.conf import settings
+from django_redis import get_redis_connection
+from datetime import datetime
+import atexit
+import os
+import random
+import socket
+import threading
+import time
+import uuid
+
+# 机器号和序号的范围
+WORKER_IDS = 10000
+SEQUENCE_SIZE = 10000
+
+# 从随机的位置开始尝试租用一个空闲的机器号
+# ARGV: 持有者, 租期(秒), 开始的机器号, 机器号的数目  返回机器号, 没有空闲的机器号时返回-1
+ACQUIRE_LUA = '''
+local count = tonumber(ARGV[4])
+for i = 0, count - 1 do
+    local worker_id = (tonumber(ARGV[3]) + i) % count
+    if redis.call('set', 'order_worker_' .. worker_id, ARGV[1], 'NX', 'EX', tonumber(ARGV[2])) then
+        return worker_id
+    end
+end
+return -1
+'''
+
+# 续租，机器号已经被其他进程租用时返回0
+# KEYS: order_worker_机器号  ARGV: 持有者, 租期(秒)
+RENEW_LUA = '''
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('expire', KEYS[1], tonumber(ARGV[2]))
+end
+return 0
+'''
+
+# 释放租用的机器号
+RELEASE_LUA = '''
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+'''
+
+
+class OrderIdError(Exception):
+    '''没有可以租用的机器号'''
+    pass
+
+
+def _worker_key(worker_id):
+    return 'order_worker_%d' % worker_id
+
+
+class OrderIdGenerator(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        self._worker_id = None
+        self._owner = None
+        # 租用或者续租成功的时间
+        self._leased_at = 0
+        self._last_ms = 0
+        self._sequence = 0
+
+    def _acquire(self):
+        '''租用一个机器号'''
+        owner = '%s:%d:%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex)
+        conn = get_redis_connection('default')
+        worker_id = conn.register_script(ACQUIRE_LUA)(
+            args=[owner, settings.ORDER_WORKER_LEASE_TIMEOUT, random.randrange(WORKER_IDS), WORKER_IDS])
+        if worker_id < 0:
+            raise OrderIdError('没有空闲的机器号')
+        self._pid = os.getpid()
+        self._worker_id = worker_id
+        self._owner = owner
+        self._leased_at = time.time()
+        # 新的机器号没有生成过订单id
+        self._last_ms = 0
+        self._sequence = 0
+
+    def _renew(self):
+        '''续租，机器号已经过期被其他进程租用时重新租用'''
+        conn = get_redis_connection('default')
+        renewed = conn.register_script(RENEW_LUA)(keys=[_worker_key(self._worker_id)],
+                                                  args=[self._owner, settings.ORDER_WORKER_LEASE_TIMEOUT])
+        if renewed:
+            self._leased_at = time.time()
+        else:
+            self._acquire()
+
+    def _ensure_lease(self):
+        if self._pid != os.getpid():
+            # fork之后的子进程不能使用父进程的机器号
+            self._acquire()
+        elif time.time() - self._leased_at >= settings.ORDER_WORKER_LEASE_TIMEOUT / 3:
+            self._renew()
+
+    def release(self):
+        '''进程退出时释放机器号'''
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+            try:
+                conn = get_redis_connection('default')
+                conn.register_script(RELEASE_LUA)(keys=[_worker_key(self._worker_id)], args=[self._owner])
+            except Exception as e:
+                # 没有释放的机器号在租期结束后自动释放
+                pass
+            self._pid = None
+
+    def next_id(self):
+        '''生成一个订单id'''
+        with self._lock:
+            self._ensure_lease()
+
+            now_ms = int(time.time() * 1000)
+            if now_ms > self._last_ms:
+                self._last_ms = now_ms
+                self._sequence = 0
+            else:
+                # 同一毫秒内或者时钟回拨时沿用上一个时间，序号递增
+                self._sequence += 1
+                if self._sequence >= SEQUENCE_SIZE:
+                    # 这一毫秒的序号用完，使用下一毫秒
+                    self._last_ms += 1
+                    self._sequence = 0
+
+            ms = self._last_ms
+            prefix = datetime.fromtimestamp(ms // 1000).strftime('%Y%m%d%H%M%S')
+            return '%s%03d%04d%04d' % (prefix, ms % 1000, self._worker_id, self._sequence)
+
+
+_generator = OrderIdGenerator()
+atexit.register(_generator.release)
+
+
+def new_order_id():
+    '''
+    生成订单id，同一个进程中线程安全
+    例如2017112212293012300010000: 2017-11-22 12:29:30.123 机器号0001 序号0000
+    '''
+    return _generator.next_id()
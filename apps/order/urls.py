@@ -1,8 +1,9 @@
 from django.conf.urls import url
-from order.views import OrderPlaceView, OrderCommitView, OrderPayView
+from order.views import OrderPlaceView, OrderCommitDispatchView, OrderStatusView, OrderPayView
 
 urlpatterns = [
     url(r'^place$', OrderPlaceView.as_view(), name='place'), # 提交订单页
-    url(r'^commit$', OrderCommitView.as_view(), name='commit'), # 订单创建
+    url(r'^commit$', OrderCommitDispatchView.as_view(), name='commit'), # 订单创建
+    url(r'^status$', OrderStatusView.as_view(), name='status'), # 异步订单创建的结果查询
     url(r'^pay$', OrderPayView.as_view(), name='pay'), # 订单支付
 ]
\ No newline at end of file
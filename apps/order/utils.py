@@ -0,0 +1,96 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q, F, Case, When, IntegerField
+from django_redis import get_redis_connection
+from goods.models import GoodsSKU
+from order.models import OrderInfo
+from utils.cache import get_or_set
+
+# 用户订单数目的缓存过期时间
+ORDER_COUNT_TIMEOUT = 600
+
+# 订单创建的统计数据: {策略:commits/failed/lock_wait_us: 数值}
+ORDER_COMMIT_STATS_KEY = 'order_commit_stats'
+# 订单创建的策略: 乐观锁，悲观锁
+ORDER_COMMIT_STRATEGIES = ('optimistic', 'pessimistic')
+
+
+def _order_count_key(user_id):
+    return 'user_order_count_%d' % int(user_id)
+
+
+def get_user_order_count(user_id):
+    '''获取用户的订单数目，用户中心订单页计算页码使用'''
+    return get_or_set(_order_count_key(user_id),
+                      lambda: OrderInfo.objects.filter(user_id=user_id).count(),
+                      ORDER_COUNT_TIMEOUT)
+
+
+def invalidate_user_order_count(user_id):
+    '''用户创建订单后，清除订单数目的缓存'''
+    cache.delete(_order_count_key(user_id))
+
+
+def choose_commit_strategy(sku_ids):
+    '''
+    选择订单创建的策略
+    订单中有settings.ORDER_HOT_SKUS中的商品时使用settings.ORDER_HOT_SKU_STRATEGY，
+    否则使用settings.ORDER_COMMIT_STRATEGY
+    '''
+    hot_skus = {int(sku_id) for sku_id in settings.ORDER_HOT_SKUS}
+    try:
+        if hot_skus and hot_skus.intersection(int(sku_id) for sku_id in sku_ids):
+            return settings.ORDER_HOT_SKU_STRATEGY
+    except ValueError as e:
+        # 商品id不合法，由订单创建校验
+        pass
+    return settings.ORDER_COMMIT_STRATEGY
+
+
+def update_sku_stocks(sales):
+    '''
+    一条update语句减少商品的库存，增加商品的销量，只更新库存足够的商品
+    update df_goods_sku set stock=case when id=5 then stock-2 ... end, sales=...
+    where (id=5 and stock>=2) or (id=6 and stock>=1);
+    sales: [(type_id, sku_id, count), ...]
+    返回更新的商品数目，小于len(sales)时有商品库存不足
+    '''
+    condition = Q()
+    for type_id, sku_id, count in sales:
+        condition |= Q(id=sku_id, stock__gte=count)
+    return GoodsSKU.objects.filter(condition).update(
+        stock=Case(*[When(id=sku_id, then=F('stock') - count) for type_id, sku_id, count in sales],
+                   output_field=IntegerField()),
+        sales=Case(*[When(id=sku_id, then=F('sales') + count) for type_id, sku_id, count in sales],
+                   output_field=IntegerField()))
+
+
+def record_order_commit(strategy, lock_wait, success):
+    '''记录一次订单创建的结果和等待行锁的时间(秒)'''
+    conn = get_redis_connection('default')
+    pipe = conn.pipeline(transaction=False)
+    pipe.hincrby(ORDER_COMMIT_STATS_KEY, '%s:%s' % (strategy, 'commits' if success else 'failed'), 1)
+    pipe.hincrby(ORDER_COMMIT_STATS_KEY, '%s:lock_wait_us' % strategy, int(lock_wait * 1000000))
+    pipe.execute()
+
+
+def get_order_commit_stats():
+    '''返回每种策略的订单创建数目，失败数目和平均等待行锁的时间'''
+    conn = get_redis_connection('default')
+    raw = conn.hgetall(ORDER_COMMIT_STATS_KEY)
+
+    stats = {strategy: {'commits': 0, 'failed': 0, 'lock_wait_us': 0} for strategy in ORDER_COMMIT_STRATEGIES}
+    for field, value in raw.items():
+        strategy, metric = field.decode().rsplit(':', 1)
+        stats.setdefault(strategy, {'commits': 0, 'failed': 0, 'lock_wait_us': 0})[metric] = int(value)
+
+    for item in stats.values():
+        total = item['commits'] + item['failed']
+        item['avg_lock_wait_ms'] = item['lock_wait_us'] / total / 1000 if total else 0
+    return stats
+
+
+def reset_order_commit_stats():
+    '''清空订单创建的统计数据'''
+    conn = get_redis_connection('default')
+    conn.delete(ORDER_COMMIT_STATS_KEY)
@@ -1,17 +1,21 @@
 from django.shortcuts import render, redirect
 from django.core.urlresolvers import reverse
-from django.db import transaction
 from django.http import JsonResponse
 from django.conf import settings
 from django.views.generic import View
 
 from user.models import Address
-from goods.models import GoodsSKU
-from order.models import OrderInfo,OrderGoods
-
-from django_redis import get_redis_connection
+from goods.sku_cache import get_skus
+from order.models import OrderInfo
+from order.utils import choose_commit_strategy
+from order.commit import commit_order, create_order_ticket, get_order_ticket, ORDER_STATUS_MAX_WAIT
+from order.flash_sale import get_flash_sku_ids, reserve_flash_order, schedule_settlement
+from order.order_id import new_order_id
+from cart.utils import delete_from_cart
+
+from utils.redis_router import get_user_connection
 from utils.mixin import LoginRequiredMixin
-from datetime import datetime
+from collections import OrderedDict
 from alipay import AliPay
 import os
 # Create your views here.
@@ -36,19 +40,23 @@ class OrderPlaceView(LoginRequiredMixin, View):
         # 获取用户的所有地址信息
         addrs = Address.objects.filter(user=user)
 
-        conn = get_redis_connection('default')
+        conn = get_user_connection(user.id)
         cart_key = 'cart_%d'%user.id
 
+        # 一次获取全部商品的信息和用户购买的数量
+        sku_dict = get_skus(sku_ids)
+        counts = conn.hmget(cart_key, sku_ids)
+
         # 保存商品的总件数和总金额
         total_count = 0
         total_price = 0
         skus = []
         # 遍历sku_ids获取每一个商品信息
-        for sku_id in sku_ids:
-            # 根据sku_id获取商品的信息
-            sku = GoodsSKU.objects.get(id=sku_id)
-            # 获取用户购买的商品的数量
-            count = conn.hget(cart_key, sku_id)
+        for sku_id, count in zip(sku_ids, counts):
+            sku = sku_dict.get(int(sku_id))
+            if sku is None or count is None:
+                # 商品不存在或者不在购物车中
+                continue
             # 计算商品的小计
             amount = sku.price*int(count)
             # 动态给sku对象增加一个属性amount,保存商品的小计
@@ -84,22 +92,17 @@ class OrderPlaceView(LoginRequiredMixin, View):
 # 前端发起ajax post请求
 # 前端传递的参数: 地址id->addr_id 支付方式->pay_method 用户要购买商品id的字符串->sku_ids
 # /order/commit
-
-
-# 用户每下一个订单，需要向订单信息表中添加一条信息
-# 向订单商品表中添加信息时，用户买了几件商品，需要添加几条记录
-# mysql事务: 一组sql操作，要么都成功，要么都失败。
-# 高并发: 防止用户下单重复
-class OrderCommitView1(View):
-    '''订单创建'''
-    @transaction.atomic
-    def post(self, request):
-        '''订单创建'''
+class OrderCommitMixin(object):
+    '''校验订单创建的参数'''
+    def validate(self, request):
+        '''
+        校验参数，返回(错误应答, None)或者(None, (user, addr, pay_method, sku_ids))
+        '''
         # 判断用户是否登录
         user = request.user
         if not user.is_authenticated():
             # 用户未登录
-            return JsonResponse({'res':0, 'errmsg':'用户未登录'})
+            return JsonResponse({'res':0, 'errmsg':'用户未登录'}), None
 
         # 接收数据
         addr_id = request.POST.get('addr_id')
@@ -108,235 +111,197 @@ class OrderCommitView1(View):
 
         # 数据校验
         if not all([addr_id, pay_method, sku_ids]):
-            return JsonResponse({'res':1, 'errmsg':'数据不完整'})
+            return JsonResponse({'res':1, 'errmsg':'数据不完整'}), None
 
         # 校验支付方式
         if pay_method not in OrderInfo.PAY_METHODS.keys():
-            return JsonResponse({'res':2, 'errmsg':'非法的支付方式'})
+            return JsonResponse({'res':2, 'errmsg':'非法的支付方式'}), None
 
         # 校验地址
         try:
-            addr = Address.objects.get(id=addr_id)
+            addr = Address.objects.get(id=addr_id, user=user)
         except Address.DoesNotExist:
             # 地址不存在
-            return JsonResponse({'res':3, 'errmsg':'地址信息错误'})
+            return JsonResponse({'res':3, 'errmsg':'地址信息错误'}), None
 
-        # 业务处理
-        # 组织订单数据
-        # 订单id: 格式:20171122122930+用户id
-        order_id = datetime.now().strftime('%Y%m%d%H%M%S')+str(user.id)
+        return None, (user, addr, pay_method, sku_ids.split(','))
 
-        # 运费
-        transit_price = 10
-
-        # 总金额和总数目
-        total_count = 0
-        total_price = 0
 
-        # todo: 设置保存点
-        save_id = transaction.savepoint()
+# 用户每下一个订单，需要向订单信息表中添加一条信息
+# 向订单商品表中添加信息时，用户买了几件商品，需要添加几条记录
+# mysql事务: 一组sql操作，要么都成功，要么都失败。
+# 高并发: 防止用户下单重复
+class OrderCommitView1(OrderCommitMixin, View):
+    '''订单创建: 悲观锁'''
+    def post(self, request):
+        '''订单创建'''
+        error, params = self.validate(request)
+        if error is not None:
+            return error
 
-        try:
-            # todo: 向订单信息表中添加一条记录
-            order = OrderInfo.objects.create(order_id=order_id,
-                                     user=user,
-                                     addr=addr,
-                                     pay_method=pay_method,
-                                     total_count=total_count,
-                                     total_price=total_price,
-                                     transit_price=transit_price)
-
-            # todo: 向订单商品表中添加信息时，用户买了几件商品，需要添加几条记录
-            conn = get_redis_connection('default')
-            cart_key = 'cart_%d'%user.id
-            sku_ids = sku_ids.split(',') # [5,6]
-
-            for sku_id in sku_ids:
-                # 根据商品的id获取商品的信息
-                try:
-                    # select * from df_order_goods where id=17 for update;
-                    sku = GoodsSKU.objects.select_for_update().get(id=sku_id)
-                except GoodsSKU.DoesNotExist:
-                    # 商品不存在
-                    transaction.savepoint_rollback(save_id)
-                    return JsonResponse({'res':4, 'errmsg':'商品不存在'})
-
-                # 从redis中获取用户要购买的商品的数量
-                count = conn.hget(cart_key, sku_id)
-
-                print("user:%d stock:%d"%(user.id, sku.stock))
-                # 判断商品的库存
-                if int(count) > sku.stock:
-                    transaction.savepoint_rollback(save_id)
-                    return JsonResponse({'res':6, 'errmsg':'商品库存不足'})
-
-                # todo: 向订单商品表中添加一条记录
-                OrderGoods.objects.create(order=order,
-                                          sku=sku,
-                                          count=count,
-                                          price=sku.price)
-
-                # todo: 更新对应商品的库存和销量
-                sku.stock -= int(count)
-                sku.sales += int(count)
-                sku.save()
-
-                # todo: 累加计算订单中商品的总数目和总金额
-                total_count += int(count)
-                amount = sku.price*int(count)
-                total_price += amount
-
-            # todo: 更新订单信息表中对应的商品的总件数和总金额
-            order.total_count = total_count
-            order.total_price = total_price
-            order.save()
-        except Exception as e:
-            # 事务回滚
-            transaction.savepoint_rollback(save_id)
-            return JsonResponse({'res':7, 'errmsg':'下单失败'})
+        # 业务处理
+        return JsonResponse(commit_order(*params, strategy='pessimistic'))
 
-        # todo: 事务提交
-        transaction.savepoint_commit(save_id)
 
-        # todo: 删除用户购物车中的相应记录
-        conn.hdel(cart_key, *sku_ids)
+class OrderCommitView(OrderCommitMixin, View):
+    '''订单创建: 乐观锁'''
+    def post(self, request):
+        '''订单创建'''
+        error, params = self.validate(request)
+        if error is not None:
+            return error
 
-        # 返回应答
-        return JsonResponse({'res':5, 'message':'订单创建成功'})
+        # 业务处理
+        return JsonResponse(commit_order(*params, strategy='optimistic'))
 
 
-class OrderCommitView(View):
-    '''订单创建'''
-    @transaction.atomic
+# 异步创建订单: 校验参数后放入celery队列，立即返回订单处理的票据
+# 前端通过/order/status查询订单处理的结果
+class OrderCommitAsyncView(OrderCommitMixin, View):
+    '''订单创建: 异步'''
     def post(self, request):
         '''订单创建'''
+        error, params = self.validate(request)
+        if error is not None:
+            return error
+
+        user, addr, pay_method, sku_ids = params
+        ticket = create_order_ticket(user.id)
+
+        # 由专门处理订单的worker执行，worker的数目控制下单的并发
+        from celery_tasks.tasks import commit_order_async
+        commit_order_async.apply_async(args=[ticket, user.id, addr.id, pay_method, sku_ids,
+                                             choose_commit_strategy(sku_ids)],
+                                       queue=settings.ORDER_COMMIT_QUEUE)
+
+        return JsonResponse({'res':8, 'ticket':ticket, 'message':'订单处理中'})
+
+
+# /order/status?ticket=票据&wait=等待的秒数
+class OrderStatusView(View):
+    '''异步创建订单的结果查询'''
+    def get(self, request):
+        '''查询'''
         # 判断用户是否登录
         user = request.user
         if not user.is_authenticated():
             # 用户未登录
             return JsonResponse({'res':0, 'errmsg':'用户未登录'})
 
-        # 接收数据
-        addr_id = request.POST.get('addr_id')
-        pay_method = request.POST.get('pay_method')
-        sku_ids = request.POST.get('sku_ids') # 5,6
+        ticket = request.GET.get('ticket')
+        try:
+            wait = min(max(int(request.GET.get('wait', 0)), 0), ORDER_STATUS_MAX_WAIT,
+                       settings.ORDER_STATUS_LONG_POLL_WAIT)
+        except ValueError as e:
+            wait = 0
 
-        # 数据校验
-        if not all([addr_id, pay_method, sku_ids]):
-            return JsonResponse({'res':1, 'errmsg':'数据不完整'})
+        # 订单还在处理时最多等待wait秒, 等待期间占用一个web进程，默认不等待，由前端定时查询
+        status = get_order_ticket(ticket, wait) if ticket else None
+        if status is None or status['user_id'] != user.id:
+            return JsonResponse({'res':1, 'errmsg':'票据不存在'})
 
-        # 校验支付方式
-        if pay_method not in OrderInfo.PAY_METHODS.keys():
-            return JsonResponse({'res':2, 'errmsg':'非法的支付方式'})
+        if status['result'] is None:
+            return JsonResponse({'res':8, 'ticket':ticket, 'message':'订单处理中'})
+        return JsonResponse(status['result'])
 
-        # 校验地址
-        try:
-            addr = Address.objects.get(id=addr_id)
-        except Address.DoesNotExist:
-            # 地址不存在
-            return JsonResponse({'res':3, 'errmsg':'地址信息错误'})
+
+# 秒杀商品的订单创建
+# 在redis中预留库存后立即返回，数据库中的订单由celery worker批量结算
+class FlashOrderCommitView(OrderCommitMixin, View):
+    '''秒杀商品订单创建'''
+    def post(self, request):
+        '''订单创建'''
+        error, params = self.validate(request)
+        if error is not None:
+            return error
+        user, addr, pay_method, sku_ids = params
 
         # 业务处理
-        # 组织订单数据
-        # 订单id: 格式:20171122122930+用户id
-        order_id = datetime.now().strftime('%Y%m%d%H%M%S')+str(user.id)
+        # 订单id: 格式:20171122122930+毫秒+机器号+序号
+        order_id = new_order_id()
 
         # 运费
         transit_price = 10
 
-        # 总金额和总数目
-        total_count = 0
-        total_price = 0
-
-        # todo: 设置保存点
-        save_id = transaction.savepoint()
+        # 去掉重复的商品id, 保持原来的顺序
+        sku_ids = list(OrderedDict.fromkeys(sku_ids)) # [5,6]
 
+        # 从redis中一次获取用户要购买的全部商品的数量
+        conn = get_user_connection(user.id)
+        cart_key = 'cart_%d'%user.id
         try:
-            # todo: 向订单信息表中添加一条记录
-            order = OrderInfo.objects.create(order_id=order_id,
-                                     user=user,
-                                     addr=addr,
-                                     pay_method=pay_method,
-                                     total_count=total_count,
-                                     total_price=total_price,
-                                     transit_price=transit_price)
-
-            # todo: 向订单商品表中添加信息时，用户买了几件商品，需要添加几条记录
-            conn = get_redis_connection('default')
-            cart_key = 'cart_%d'%user.id
-            sku_ids = sku_ids.split(',') # [5,6]
-
-            for sku_id in sku_ids:
-                for i in range(3):
-                    # 根据商品的id获取商品的信息
-                    try:
-                        # select * from df_order_goods where id=17 for update;
-                        sku = GoodsSKU.objects.get(id=sku_id)
-                    except GoodsSKU.DoesNotExist:
-                        # 商品不存在
-                        transaction.savepoint_rollback(save_id)
-                        return JsonResponse({'res':4, 'errmsg':'商品不存在'})
-
-                    # 从redis中获取用户要购买的商品的数量
-                    count = conn.hget(cart_key, sku_id)
-
-                    # 更新时做判断, 判断更新时和之前查到的库存是否一致
-
-                    # todo: 更新对应商品的库存和销量
-                    origin_stock = sku.stock
-                    news_stock = origin_stock - int(count)
-                    news_sales = sku.sales + int(count)
-                    # print('user:%d times:%d stock:%d' % (user.id, i, origin_stock))
-
-                    # 判断商品的库存
-                    if int(count) > sku.stock:
-                        transaction.savepoint_rollback(save_id)
-                        return JsonResponse({'res': 6, 'errmsg': '商品库存不足'})
-
-                    # 返回受影响的函数
-                    # update df_order_goods set stock=news_stock and sales=new_sales
-                    # where id=sku_id and stock = orgin_stock;
-                    res = GoodsSKU.objects.filter(id=sku_id, stock=origin_stock).update(stock=news_stock,
-                                                                                        sales=news_sales)
-                    if res == 0:
-                        # 尝试3次
-                        if i == 2:
-                            transaction.savepoint_rollback(save_id)
-                            return JsonResponse({'res': 7, 'errmsg': '下单失败2'})
-                        continue
-
-                    # todo: 向订单商品表中添加一条记录
-                    OrderGoods.objects.create(order=order,
-                                              sku=sku,
-                                              count=count,
-                                              price=sku.price)
-
-                    # todo: 累加计算订单中商品的总数目和总金额
-                    total_count += int(count)
-                    amount = sku.price*int(count)
-                    total_price += amount
-
-                    # 结束三次循环
-                    break
-
-            # todo: 更新订单信息表中对应的商品的总件数和总金额
-            order.total_count = total_count
-            order.total_price = total_price
-            order.save()
-        except Exception as e:
-            # 事务回滚
-            print(e)
-            transaction.savepoint_rollback(save_id)
+            counts = [int(count) for count in conn.hmget(cart_key, sku_ids)]
+        except (TypeError, ValueError) as e:
+            # 商品不在购物车中
             return JsonResponse({'res':7, 'errmsg':'下单失败'})
 
-        # todo: 事务提交
-        transaction.savepoint_commit(save_id)
+        # 商品的价格从缓存中获取，不查询数据库
+        sku_dict = get_skus(sku_ids)
+        if len(sku_dict) != len(sku_ids):
+            # 商品不存在
+            return JsonResponse({'res':4, 'errmsg':'商品不存在'})
+
+        lines = []
+        for sku_id, count in zip(sku_ids, counts):
+            sku = sku_dict[int(sku_id)]
+            lines.append([str(sku.id), count, str(sku.price), sku.type_id])
+
+        # 订单id作为票据，结算完成之后前端才能知道订单是否创建成功
+        # 在预留之前创建，结算的结果不会被覆盖
+        create_order_ticket(user.id, order_id)
+
+        # 在redis中原子地预留全部商品的库存
+        res = reserve_flash_order({'order_id': order_id,
+                                   'user_id': user.id,
+                                   'addr_id': addr.id,
+                                   'pay_method': int(pay_method),
+                                   'transit_price': str(transit_price),
+                                   'lines': lines})
+        if res == 0:
+            return JsonResponse({'res':6, 'errmsg':'商品库存不足'})
+        elif res != 1:
+            # 秒杀已经结束或者订单id重复
+            return JsonResponse({'res':7, 'errmsg':'下单失败'})
 
-        # todo: 删除用户购物车中的相应记录
-        conn.hdel(cart_key, *sku_ids)
+        # 安排结算任务
+        schedule_settlement()
 
-        # 返回应答
-        return JsonResponse({'res':5, 'message':'订单创建成功'})
+        # todo: 删除用户购物车中的相应记录, 同时更新购物车中商品的总件数
+        delete_from_cart(user.id, *sku_ids)
+
+        # 返回应答, 前端查询/order/status获取结算的结果
+        return JsonResponse({'res':8, 'ticket':order_id, 'order_id':order_id, 'message':'订单处理中'})
+
+
+# /order/commit
+# 秒杀商品使用FlashOrderCommitView, settings.ORDER_COMMIT_MODE为async时使用OrderCommitAsyncView,
+# 其他商品按照settings.ORDER_COMMIT_STRATEGY和订单中的热门商品选择悲观锁或者乐观锁创建订单
+class OrderCommitDispatchView(View):
+    '''订单创建'''
+    strategy_views = {
+        'pessimistic': OrderCommitView1.as_view(),
+        'optimistic': OrderCommitView.as_view(),
+    }
+    flash_view = FlashOrderCommitView.as_view()
+    async_view = OrderCommitAsyncView.as_view()
+
+    def post(self, request):
+        '''订单创建'''
+        sku_ids = [sku_id for sku_id in request.POST.get('sku_ids', '').split(',') if sku_id]
+
+        # 秒杀商品在redis中预留库存
+        flash_sku_ids = get_flash_sku_ids(sku_ids)
+        if flash_sku_ids:
+            if len(flash_sku_ids) != len(set(sku_ids)):
+                return JsonResponse({'res':7, 'errmsg':'秒杀商品需要单独下单'})
+            return self.flash_view(request)
+
+        # 异步创建订单
+        if settings.ORDER_COMMIT_MODE == 'async':
+            return self.async_view(request)
+
+        view = self.strategy_views[choose_commit_strategy(sku_ids)]
+        return view(request)
 
 
 # 前端 ajax post访问/order/pay
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from utils.ratelimit import get_throttle_stats, reset_throttle_stats
+
+
+class Command(BaseCommand):
+    '''显示每个url被频率限制拒绝的请求数目'''
+    help = '显示每个url被频率限制拒绝的请求数目'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='显示后清空统计数据')
+
+    def handle(self, *args, **options):
+        stats = get_throttle_stats()
+
+        self.stdout.write('%-20s %10s' % ('url', 'throttled'))
+        for name in sorted(stats):
+            self.stdout.write('%-20s %10d' % (name, stats[name]))
+
+        if options['reset']:
+            reset_throttle_stats()
+            self.stdout.write('统计数据已清空')
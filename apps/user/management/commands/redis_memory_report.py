@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from utils.redis_memory import memory_report
+
+
+class Command(BaseCommand):
+    '''统计redis中每类key的数目，占用的内存和编码'''
+    help = '统计redis中每类key的数目，占用的内存和编码(listpack/ziplist还是hashtable)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('nodes', nargs='*', help='要统计的节点，CACHES中的配置名称，默认default和全部用户分片')
+        parser.add_argument('--sample', type=int, default=100, help='每类key采样的数目')
+        parser.add_argument('--count', type=int, default=1000, help='每批SCAN的key数目')
+
+    def handle(self, *args, **options):
+        nodes = options['nodes'] or sorted({'default'} | set(getattr(settings, 'REDIS_USER_SHARDS', None) or []))
+        unknown = [node for node in nodes if node not in settings.CACHES]
+        if unknown:
+            raise CommandError('未知的redis节点: %s' % ', '.join(unknown))
+
+        for node in nodes:
+            report = memory_report(node, options['sample'], options['count'])
+            self.stdout.write('[%s]' % node)
+            self.stdout.write('%-14s %10s %8s %10s %12s  %s' % ('family', 'keys', 'sampled', 'avg_bytes',
+                                                              'total_mb', 'encodings'))
+            for name, item in report.items():
+                if not item['keys']:
+                    continue
+                encodings = ' '.join('%s:%d' % (encoding, num) for encoding, num in sorted(item['encodings'].items()))
+                self.stdout.write('%-14s %10d %8d %10.1f %12.2f  %s' % (name, item['keys'], item['sampled'],
+                                                                      item['avg_bytes'],
+                                                                      item['total_bytes'] / 1024 / 1024, encodings))
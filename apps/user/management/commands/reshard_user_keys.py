@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from utils.redis_router import migrate_user_keys
+import time
+
+
+class Command(BaseCommand):
+    '''redis节点变化后迁移用户的购物车和浏览记录'''
+    help = 'redis节点变化后迁移用户的购物车和浏览记录，先发布新的REDIS_USER_SHARDS和REDIS_USER_SHARDS_PREVIOUS再执行'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='old_nodes', required=True,
+                            help='变化之前的节点列表，逗号分隔，例如default,user1')
+        parser.add_argument('--to', dest='new_nodes',
+                            help='变化之后的节点列表，逗号分隔，默认使用settings.REDIS_USER_SHARDS')
+        parser.add_argument('--scan-count', type=int, default=500, help='每次SCAN返回的key数目')
+        parser.add_argument('--dry-run', action='store_true', help='只统计需要迁移的key数目，不迁移')
+
+    def handle(self, *args, **options):
+        old_nodes = [node for node in options['old_nodes'].split(',') if node]
+        new_nodes = [node for node in (options['new_nodes'] or '').split(',') if node] or None
+        unknown = [node for node in old_nodes + (new_nodes or []) if node not in settings.CACHES]
+        if unknown:
+            raise CommandError('未知的redis节点: %s' % ', '.join(unknown))
+
+        start = time.time()
+        stats = migrate_user_keys(old_nodes, new_nodes, options['scan_count'], options['dry_run'])
+
+        self.stdout.write('%-16s %10s %10s %10s' % ('node', 'moved', 'conflicts', 'dropped'))
+        for node, item in stats.items():
+            self.stdout.write('%-16s %10d %10d %10d' % (node, item['moved'], item['conflicts'], item['dropped']))
+        self.stdout.write('%s完成，总耗时%.1fms' % ('试运行' if options['dry_run'] else '迁移',
+                                               (time.time() - start) * 1000))
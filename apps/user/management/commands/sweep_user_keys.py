@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from utils.redis_memory import sweep_user_keys
+import time
+
+
+class Command(BaseCommand):
+    '''清理长时间没有访问并且没有设置过期时间的购物车和浏览记录'''
+    help = '清理长时间没有访问并且没有设置过期时间的购物车和浏览记录'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=500, help='每批SCAN的key数目')
+        parser.add_argument('--pause', type=float, default=0, help='每批之间暂停的秒数')
+        parser.add_argument('--archive', help='删除之前把购物车和浏览记录追加到这个文件，每行一个json')
+        parser.add_argument('--dry-run', action='store_true', help='只统计，不修改')
+
+    def handle(self, *args, **options):
+        start = time.time()
+        archive = open(options['archive'], 'a') if options['archive'] and not options['dry_run'] else None
+        try:
+            stats = sweep_user_keys(count=options['count'], pause=options['pause'],
+                                    archive=archive, dry_run=options['dry_run'])
+        finally:
+            if archive is not None:
+                archive.close()
+
+        self.stdout.write('%-16s %10s %10s %10s' % ('node', 'scanned', 'expired', 'removed'))
+        for node, item in stats.items():
+            self.stdout.write('%-16s %10d %10d %10d' % (node, item['scanned'], item['expired'], item['removed']))
+        self.stdout.write('%s完成，总耗时%.1fms' % ('试运行' if options['dry_run'] else '清理',
+                                               (time.time() - start) * 1000))
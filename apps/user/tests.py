@@ -1,3 +1,104 @@
-from django.test import TestCase
+from django.test import SimpleTestCase, override_settings
+from django_redis import get_redis_connection
+from cart.utils import add_to_cart, delete_from_cart, get_cart
+from user.utils import add_history, get_history
+from utils.redis_router import get_user_node, migrate_user_keys
+import os
+import unittest
 
 # Create your tests here.
+
+# 用户key分片的测试使用本地启动的多个redis-server，例如:
+# redis-server --port 6380 --save '' & redis-server --port 6381 --save '' &
+# REDIS_TEST_URLS=redis://127.0.0.1:6380/0,redis://127.0.0.1:6381/0 python manage.py test user
+# 测试会清空这些redis中的数据
+REDIS_TEST_URLS = [url for url in os.environ.get('REDIS_TEST_URLS', '').split(',') if url]
+SHARDS = ['shard%d' % i for i in range(len(REDIS_TEST_URLS))]
+
+
+def _caches():
+    caches = {node: {'BACKEND': 'django_redis.cache.RedisCache',
+                     'LOCATION': url,
+                     'OPTIONS': {'CLIENT_CLASS': 'django_redis.client.DefaultClient'}}
+              for node, url in zip(SHARDS, REDIS_TEST_URLS)}
+    caches['default'] = dict(caches[SHARDS[0]]) if SHARDS else {}
+    return caches
+
+
+@unittest.skipUnless(len(REDIS_TEST_URLS) >= 2, '需要设置REDIS_TEST_URLS为至少两个redis地址')
+@override_settings(CACHES=_caches(), REDIS_USER_SHARDS=SHARDS[:1], REDIS_USER_SHARDS_PREVIOUS=[],
+                   CART_TTL=3600, HISTORY_TTL=3600, HISTORY_LENGTH=5)
+class UserKeyReshardTest(SimpleTestCase):
+    '''增加redis节点之后迁移用户的购物车和浏览记录'''
+    def setUp(self):
+        for node in SHARDS:
+            get_redis_connection(node).flushdb()
+
+    def _moved_user(self):
+        '''返回增加节点之后需要迁移的用户id'''
+        for user_id in range(1, 1000):
+            if get_user_node(user_id, SHARDS) != SHARDS[0]:
+                return user_id
+
+    def _fill(self, user_id):
+        '''在旧的节点上创建购物车和浏览记录'''
+        add_to_cart(user_id, 1, 2, 10)
+        add_to_cart(user_id, 3, 4, 10)
+        add_history(user_id, 1)
+        add_history(user_id, 3)
+
+    def test_users_spread_over_shards(self):
+        nodes = {get_user_node(user_id, SHARDS) for user_id in range(1, 200)}
+        self.assertEqual(nodes, set(SHARDS))
+
+    def test_migrate_user_keys(self):
+        user_id = self._moved_user()
+        self._fill(user_id)
+        target = get_user_node(user_id, SHARDS)
+
+        with self.settings(REDIS_USER_SHARDS=SHARDS):
+            stats = migrate_user_keys(SHARDS[:1], SHARDS)
+            self.assertEqual(stats[SHARDS[0]]['moved'], 2)
+            self.assertEqual(get_cart(user_id), ({b'1': b'2', b'3': b'4'}, 6))
+            self.assertEqual(get_history(user_id), [3, 1])
+
+        self.assertFalse(get_redis_connection(SHARDS[0]).exists('cart_%d' % user_id))
+        self.assertTrue(get_redis_connection(target).ttl('cart_%d' % user_id) > 0)
+
+    def test_read_during_migration(self):
+        '''发布新的节点之后，迁移完成之前，用户仍然能看到自己的购物车'''
+        user_id = self._moved_user()
+        self._fill(user_id)
+
+        with self.settings(REDIS_USER_SHARDS=SHARDS, REDIS_USER_SHARDS_PREVIOUS=SHARDS[:1]):
+            self.assertEqual(get_cart(user_id), ({b'1': b'2', b'3': b'4'}, 6))
+            self.assertEqual(delete_from_cart(user_id, 1), (1, 4))
+            # 迁移时旧的节点上已经没有这个用户的key
+            stats = migrate_user_keys(SHARDS[:1], SHARDS)
+            self.assertEqual(stats[SHARDS[0]]['moved'], 0)
+            self.assertEqual(get_cart(user_id), ({b'3': b'4'}, 4))
+
+    def test_merge_with_keys_written_on_new_node(self):
+        '''新的节点上已经有数据时合并，总件数从合并后的购物车重新计算'''
+        user_id = self._moved_user()
+        self._fill(user_id)
+
+        with self.settings(REDIS_USER_SHARDS=SHARDS):
+            # 没有回退读取时在新的节点上修改了购物车
+            add_to_cart(user_id, 3, 1, 10)
+            add_history(user_id, 5)
+            stats = migrate_user_keys(SHARDS[:1], SHARDS)
+            self.assertEqual(stats[SHARDS[0]]['conflicts'], 2)
+            # 同一个商品保留新的数目，旧的浏览记录排在后面
+            self.assertEqual(get_cart(user_id), ({b'1': b'2', b'3': b'1'}, 3))
+            self.assertEqual(get_history(user_id), [5, 3, 1])
+
+    def test_total_recomputed_after_restore(self):
+        '''新的节点上只有总件数(删除了不存在的购物车记录)时，迁移之后总件数和购物车一致'''
+        user_id = self._moved_user()
+        self._fill(user_id)
+
+        with self.settings(REDIS_USER_SHARDS=SHARDS):
+            delete_from_cart(user_id, 9)
+            migrate_user_keys(SHARDS[:1], SHARDS)
+            self.assertEqual(get_cart(user_id), ({b'1': b'2', b'3': b'4'}, 6))
@@ -0,0 +1,75 @@
+# 用户的历史浏览记录
+# history_用户id: [sku_id, ...] 最近浏览的商品在左侧，最多保存settings.HISTORY_LENGTH个
+from django.conf import settings
+from cart.utils import cart_key, get_cart_count
+from utils.redis_router import get_user_connection
+from concurrent.futures import ThreadPoolExecutor
+
+# 异步写浏览记录的线程池
+_history_executor = None
+
+
+def history_key(user_id):
+    return 'history_%d' % user_id
+
+
+def _add_history(pipe, user_id, sku_id):
+    key = history_key(user_id)
+    # 先尝试移除列表中sku_id
+    pipe.lrem(key, 0, sku_id)
+    # 将sku_id插入到列表的左侧
+    pipe.lpush(key, sku_id)
+    # 只保留用户浏览的最新HISTORY_LENGTH个商品
+    pipe.ltrim(key, 0, settings.HISTORY_LENGTH - 1)
+    if settings.HISTORY_TTL:
+        pipe.expire(key, settings.HISTORY_TTL)
+
+
+def add_history(user_id, sku_id):
+    '''添加历史浏览记录，一次往返完成'''
+    pipe = get_user_connection(user_id).pipeline()
+    _add_history(pipe, user_id, sku_id)
+    pipe.execute()
+
+
+def _add_history_quietly(user_id, sku_id):
+    try:
+        add_history(user_id, sku_id)
+    except Exception as e:
+        # 浏览记录丢失不影响页面，不重试
+        pass
+
+
+def add_history_async(user_id, sku_id):
+    '''在后台线程中添加历史浏览记录，不等待redis'''
+    global _history_executor
+    if _history_executor is None:
+        _history_executor = ThreadPoolExecutor(max_workers=settings.HISTORY_WRITE_WORKERS)
+    _history_executor.submit(_add_history_quietly, user_id, sku_id)
+
+
+def add_history_and_get_cart_count(user_id, sku_id):
+    '''
+    商品详情页: 添加历史浏览记录并获取购物车中商品的条目数
+    同步写浏览记录时和获取购物车条目数在一次往返中完成
+    settings.HISTORY_ASYNC为True时浏览记录在后台线程中写入
+    '''
+    if settings.HISTORY_ASYNC:
+        add_history_async(user_id, sku_id)
+        return get_cart_count(user_id)
+
+    pipe = get_user_connection(user_id).pipeline()
+    pipe.hlen(cart_key(user_id))
+    _add_history(pipe, user_id, sku_id)
+    return pipe.execute()[0]
+
+
+def get_history(user_id):
+    '''获取用户浏览的商品id的列表，最近浏览的在前'''
+    key = history_key(user_id)
+    pipe = get_user_connection(user_id).pipeline(transaction=False)
+    pipe.lrange(key, 0, settings.HISTORY_LENGTH - 1)
+    if settings.HISTORY_TTL:
+        # 访问浏览记录时重新设置过期时间
+        pipe.expire(key, settings.HISTORY_TTL)
+    return [int(sku_id) for sku_id in pipe.execute()[0]]
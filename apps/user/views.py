@@ -3,21 +3,22 @@ from django.core.urlresolvers import reverse
 from django.conf import settings
 from django.contrib.auth import authenticate, login, logout
 from django.http import HttpResponse
-from django.core.paginator import  Paginator
 from django.views.generic import View
 from django.core.mail import send_mail
 
 from user.models import User, Address
-from goods.models import GoodsSKU
+from goods.sku_cache import get_skus
 from order.models import OrderInfo, OrderGoods
 
 from utils.mixin import LoginRequiredMixin
+from utils.pagination import keyset_paginate, page_range
+from order.utils import get_user_order_count
 from celery_tasks.tasks import send_register_active_email
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
 from itsdangerous import SignatureExpired
 import re
 import time
-from django_redis import get_redis_connection
+from user.utils import get_history
 # Create your views here.
 
 
@@ -242,18 +243,12 @@ class UserInfoView(LoginRequiredMixin, View):
         address = Address.objects.get_default_address(user=user)
 
         # 用户历史浏览记录
-        # 获取redis链接对象->StrictReids
-        conn = get_redis_connection('default')
-        list_key = 'history_%d'%user.id
-
         # 从redis中获取用户浏览的商品id的列表
-        sku_ids = conn.lrange(list_key, 0, 4) # [3,2,1]
+        sku_ids = get_history(user.id) # [3,2,1]
 
-        # 遍历查询用户历史浏览的商品信息，追加到goods_li列表中
-        goods_li = []
-        for id in sku_ids:
-            goods = GoodsSKU.objects.get(id=id)
-            goods_li.append(goods)
+        # 一次查询用户历史浏览的商品信息，按照浏览的顺序追加到goods_li列表中
+        sku_dict = get_skus(sku_ids)
+        goods_li = [sku_dict[id] for id in sku_ids if id in sku_dict]
 
         # 组织模板上下文
         context = {'page':'user', 'address':address, 'goods_li':goods_li}
@@ -267,57 +262,34 @@ class UserOrderView(LoginRequiredMixin, View):
     '''用户中心-订单页'''
     def get(self, request, page):
         '''显示'''
-        # 获取用户的所有订单信息
+        # 获取用户的订单信息
         user = request.user
-        orders = OrderInfo.objects.filter(user=user).order_by('-create_time')
-
-        # 遍历获取订单商品的信息
-        # OrderInfo类实例对象
-        for order in orders:
-            # 根据order_id获取订单商品信息
-            order_skus = OrderGoods.objects.filter(order_id=order.order_id)
-
+        orders = OrderInfo.objects.filter(user=user)
+
+        # 分页, 订单总数从缓存中获取，前后翻页使用游标
+        after = request.GET.get('after')
+        before = request.GET.get('before')
+        order_page = keyset_paginate(orders, ['-create_time', '-order_id'], page, 1,
+                                     get_user_order_count(user.id), after, before)
+
+        # 只查询当前页订单的商品信息
+        order_ids = [order.order_id for order in order_page]
+        order_skus_dict = {}
+        for order_sku in OrderGoods.objects.filter(order_id__in=order_ids).select_related('sku'):
             # 计算商品的小计
-            # OrderGoods类的实例对象
-            for order_sku in order_skus:
-                amount = order_sku.price*order_sku.count
-                # 动态给order_sku增加一个属性amount,保存商品的小计
-                order_sku.amount = amount
+            # 动态给order_sku增加一个属性amount,保存商品的小计
+            order_sku.amount = order_sku.price*order_sku.count
+            order_skus_dict.setdefault(order_sku.order_id, []).append(order_sku)
 
+        # OrderInfo类实例对象
+        for order in order_page:
             # 动态给order增加一个属性status_name, 保存订单的状态标题
             order.status_name = OrderInfo.ORDER_STATUS[order.order_status]
             # 动态给order增加一个属性order_skus，保存订单商品的信息
-            order.order_skus = order_skus
-
-        # 分页
-        paginator = Paginator(orders, 1)
-
-        # 处理页码
-        try:
-            page = int(page)
-        except Exception as e:
-            page = 1
-
-        if page > paginator.num_pages:
-            page = 1
-
-        # 获取第page页的Page对象
-        order_page = paginator.page(page)
+            order.order_skus = order_skus_dict.get(order.order_id, [])
 
         # 控制页码的列表，最多在页面上只显示5个页码
-        # 1.总页数小于5页，显示所有页码
-        # 2.当前页属于前3页，显示前5页
-        # 3.当前页属于后3页，显示后5页
-        # 4.其他情况，显示当前页的前2页，当前页，当前页后2页
-        num_pages = paginator.num_pages
-        if num_pages < 5:
-            pages = range(1, num_pages + 1)
-        elif page <= 3:
-            pages = range(1, 6)
-        elif num_pages - page <= 2:
-            pages = range(num_pages - 4, num_pages + 1)
-        else:
-            pages = range(page - 2, page + 3)
+        pages = page_range(order_page.num_pages, order_page.number)
 
         # 组织上下文
         context = {'order_page':order_page,
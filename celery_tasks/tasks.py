@@ -3,6 +3,7 @@ from django.core.mail import send_mail
 from django.conf import settings
 from django.template import loader, RequestContext
 from celery import Celery
+from datetime import timedelta
 import time
 
 # 初始化django项目所依赖的环境
@@ -11,12 +12,48 @@ import os
 # os.environ.setdefault("DJANGO_SETTINGS_MODULE", "dailyfresh.settings")
 # django.setup()
 
-from goods.models import GoodsType, IndexGoodsBanner, IndexPromotionBanner, IndexTypeGoodsBanner
+from goods.models import GoodsType, GoodsSKU
+from goods.utils import build_index_page_data, get_detail_context, get_list_context, LIST_SORTS
+from goods.rankings import rebuild_type_rankings
+from goods.stock import reconcile_stocks
+from utils.redis_memory import sweep_user_keys
+from order.flash_sale import settle_reservations, reap_expired_reservations
+from django.db.models import Count, Max, Sum
+from utils.static_page import publish_static_page
 from django_redis import get_redis_connection
 
 # 创建一个Celery类的对象
 app = Celery('celery_tasks.tasks', broker='redis://172.16.179.142:6379/5')
 
+# 定期执行的任务，启动: celery -A celery_tasks.tasks beat
+app.conf.CELERYBEAT_SCHEDULE = {
+    # 退回超时的秒杀预留，结算超时的预留重新结算
+    'reap-flash-reservations': {
+        'task': 'celery_tasks.tasks.reap_flash_reservations',
+        'schedule': timedelta(minutes=1),
+    },
+    # 用数据库中的价格和销量校正分类排行
+    'reconcile-sku-rankings': {
+        'task': 'celery_tasks.tasks.reconcile_sku_rankings',
+        'schedule': timedelta(hours=1),
+    },
+    # 用数据库中的库存校正redis中的库存镜像
+    'reconcile-sku-stocks': {
+        'task': 'celery_tasks.tasks.reconcile_sku_stocks',
+        'schedule': timedelta(minutes=10),
+    },
+    # 清理长时间没有访问的购物车和浏览记录
+    'sweep-user-redis-keys': {
+        'task': 'celery_tasks.tasks.sweep_user_redis_keys',
+        'schedule': timedelta(days=1),
+    },
+    # 增量生成商品的详情页和列表页静态页
+    'generate-static-catalog': {
+        'task': 'celery_tasks.tasks.generate_static_catalog',
+        'schedule': timedelta(minutes=5),
+    },
+}
+
 # 创建任务函数
 @app.task
 def send_register_active_email(to_email, username, token):
@@ -33,48 +70,199 @@ def send_register_active_email(to_email, username, token):
     time.sleep(5)
 
 
+def render_static_index_html(context=None):
+    '''渲染首页静态页的内容'''
+    # 组织模板上下文
+    # 直接从数据库查询，缓存中的片段可能还没有更新(其他请求正在重建时会返回旧的数据)
+    if context is None:
+        context = build_index_page_data()
+
+    # 获取购物车商品数量
+    cart_count = 0
+    context.update(cart_count=cart_count)
+
+    # 1.加载模板文件, 返回一个模板对象
+    temp = loader.get_template('static_index.html')
+    # 2.模板渲染:产生替换变量后的内容
+    return temp.render(context)
+
+
 @app.task
 def generate_static_index_html():
     '''生成首页静态页'''
-    # 获取商品的分类信息
-    types = GoodsType.objects.all()
+    static_html = render_static_index_html()
 
-    # 获取首页轮播商品信息
-    goods_banners = IndexGoodsBanner.objects.all().order_by('index')
+    # 生成静态文件, 内容没有变化时不重写
+    save_path = os.path.join(settings.BASE_DIR, 'static/index.html')
+    return publish_static_page(save_path, static_html)
 
-    # 获取首页促销活动信息
-    promotion_banners = IndexPromotionBanner.objects.all().order_by('index')
 
-    # 获取首页分类商品展示信息
-    for type in types:  # GoodsType->对象
-        image_banners = IndexTypeGoodsBanner.objects.filter(type=type, display_type=1).order_by('index')
-        title_banners = IndexTypeGoodsBanner.objects.filter(type=type, display_type=0).order_by('index')
-        # 动态给type对象增加属性，分别保存首页展示的图片商品信息和标题商品信息
-        type.image_banners = image_banners
-        type.title_banners = title_banners
+# 静态详情页和列表页的生成记录: {sku_id: 生成时商品的update_time}, {type_id: 生成时分类商品的签名}
+STATIC_DETAIL_VERSIONS_KEY = 'static_detail_versions'
+STATIC_LIST_VERSIONS_KEY = 'static_list_versions'
 
-    # 获取购物车商品数量
-    cart_count = 0
+# 每个任务生成的详情页数目
+STATIC_DETAIL_CHUNK_SIZE = 50
 
-    # 组织模板上下文
-    context = {'types': types,
-               'goods_banners': goods_banners,
-               'promotion_banners': promotion_banners,
-               'cart_count': cart_count}
 
-    # 1.加载模板文件, 返回一个模板对象
-    temp = loader.get_template('static_index.html')
-    # 2.模板渲染:产生替换变量后的内容
-    static_html = temp.render(context)
+def static_detail_path(sku_id):
+    '''详情页静态页的路径: /goods/商品id->static/goods/商品id.html'''
+    return os.path.join(settings.BASE_DIR, 'static/goods/%d.html' % int(sku_id))
 
-    # 生成静态文件
-    save_path = os.path.join(settings.BASE_DIR, 'static/index.html')
-    with open(save_path, 'w') as f:
-        f.write(static_html)
 
+def static_list_dir(type_id):
+    '''列表页静态页的目录: /list/种类id/页码?sort=排序方式->static/list/种类id/页码_排序方式.html'''
+    return os.path.join(settings.BASE_DIR, 'static/list/%d' % int(type_id))
+
+
+def _remove_static_page(path):
+    '''删除静态页，nginx找不到静态页时由django处理请求'''
+    for name in (path, path + '.gz'):
+        if os.path.exists(name):
+            os.remove(name)
+
+
+@app.task
+def generate_static_detail_pages(sku_ids):
+    '''生成一批商品的详情页静态页'''
+    conn = get_redis_connection('default')
+    skus = GoodsSKU.objects.filter(id__in=sku_ids, status=1).select_related('type', 'goods')
+
+    versions = {}
+    for sku in skus:
+        context = get_detail_context(sku)
+        # 静态页没有请求，使用没有登录信息的static_base.html
+        context.update(cart_count=0, base_template='static_base.html')
+        static_html = loader.get_template('detail.html').render(context)
+        publish_static_page(static_detail_path(sku.id), static_html)
+        versions[sku.id] = sku.update_time.timestamp()
+
+    if versions:
+        conn.hmset(STATIC_DETAIL_VERSIONS_KEY, versions)
+
+
+@app.task
+def generate_static_list_pages(type_id, signature=None):
+    '''生成一个分类所有排序方式和页码的列表页静态页'''
+    try:
+        type = GoodsType.objects.get(id=type_id)
+    except GoodsType.DoesNotExist:
+        return
 
+    published = set()
+    for sort in LIST_SORTS:
+        page = 1
+        while True:
+            context = get_list_context(type, page, sort)
+            context.update(cart_count=0, base_template='static_base.html')
+            static_html = loader.get_template('list.html').render(context)
 
+            name = '%d_%s.html' % (page, sort)
+            publish_static_page(os.path.join(static_list_dir(type.id), name), static_html)
+            published.add(name)
 
+            if not context['skus_page'].has_next():
+                break
+            page += 1
 
+    # 删除商品减少后多出来的页
+    for name in os.listdir(static_list_dir(type.id)):
+        if name.endswith('.html') and name not in published:
+            _remove_static_page(os.path.join(static_list_dir(type.id), name))
 
+    if signature is not None:
+        conn = get_redis_connection('default')
+        conn.hset(STATIC_LIST_VERSIONS_KEY, type.id, signature)
 
+
+@app.task
+def generate_static_catalog():
+    '''
+    增量生成全部商品的详情页和列表页静态页
+    只重新生成update_time变化的商品的详情页和商品有变化的分类的列表页，
+    生成任务按批分发给多个worker，由celery beat每5分钟执行
+    '''
+    conn = get_redis_connection('default')
+
+    # 详情页: 只生成上线的商品
+    rendered = {int(sku_id): float(ts) for sku_id, ts in conn.hgetall(STATIC_DETAIL_VERSIONS_KEY).items()}
+    online = dict(GoodsSKU.objects.filter(status=1).values_list('id', 'update_time'))
+
+    changed = [sku_id for sku_id, update_time in online.items()
+               if rendered.get(sku_id) != update_time.timestamp()]
+    for i in range(0, len(changed), STATIC_DETAIL_CHUNK_SIZE):
+        generate_static_detail_pages.delay(changed[i:i + STATIC_DETAIL_CHUNK_SIZE])
+
+    # 下线或者删除的商品，删除静态页
+    removed = [sku_id for sku_id in rendered if sku_id not in online]
+    for sku_id in removed:
+        _remove_static_page(static_detail_path(sku_id))
+    if removed:
+        conn.hdel(STATIC_DETAIL_VERSIONS_KEY, *removed)
+
+    # 列表页: 分类中商品的最后修改时间、数目和总销量作为签名
+    # 下单时用update()增加销量，不修改update_time，销量排序的列表页需要根据总销量判断是否变化
+    rendered = {int(type_id): sig.decode() for type_id, sig in conn.hgetall(STATIC_LIST_VERSIONS_KEY).items()}
+    type_stats = GoodsSKU.objects.values('type_id').annotate(last_update=Max('update_time'), count=Count('id'),
+                                                             sales=Sum('sales'))
+    for item in type_stats:
+        signature = '%s:%d:%d' % (item['last_update'].timestamp(), item['count'], item['sales'])
+        if rendered.get(item['type_id']) != signature:
+            generate_static_list_pages.delay(item['type_id'], signature)
+
+    return len(changed)
+
+
+@app.task
+def rebuild_sku_rankings(type_id):
+    '''从数据库重建一个分类的商品排行'''
+    return rebuild_type_rankings(type_id)
+
+
+@app.task
+def reconcile_sku_rankings():
+    '''用数据库中的价格和销量校正全部分类的商品排行，由celery beat每小时执行'''
+    for type_id in GoodsType.objects.values_list('id', flat=True):
+        rebuild_type_rankings(type_id)
+
+
+@app.task
+def reconcile_sku_stocks():
+    '''用数据库中的库存校正redis中的库存镜像，由celery beat每10分钟执行'''
+    return reconcile_stocks()
+
+
+@app.task
+def sweep_user_redis_keys():
+    '''清理长时间没有访问的购物车和浏览记录，由celery beat每天执行'''
+    return sweep_user_keys(pause=0.01)
+
+
+@app.task
+def settle_flash_orders():
+    '''批量结算秒杀商品的订单'''
+    return settle_reservations()
+
+
+@app.task
+def reap_flash_reservations():
+    '''退回超时没有结算的秒杀商品预留的库存，重新结算超时没有完成的结算，由celery beat每分钟执行'''
+    return reap_expired_reservations()
+
+
+@app.task
+def commit_order_async(ticket, user_id, addr_id, pay_method, sku_ids, strategy):
+    '''
+    异步创建订单，由处理订单队列的worker执行:
+    celery -A celery_tasks.tasks worker -Q order -c 4
+    '''
+    from user.models import User, Address
+    from order.commit import commit_order, finish_order_ticket
+    try:
+        user = User.objects.get(id=user_id)
+        addr = Address.objects.get(id=addr_id)
+        result = commit_order(user, addr, pay_method, sku_ids, strategy)
+    except Exception as e:
+        result = {'res':7, 'errmsg':'下单失败'}
+    finish_order_ticket(ticket, user_id, result)
+    return result['res']
@@ -56,6 +56,8 @@ MIDDLEWARE_CLASSES = (
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'utils.ratelimit.RateLimitMiddleware', # 请求频率限制
+    'utils.admission.AdmissionControlMiddleware', # 热门商品的准入控制
 )
 
 ROOT_URLCONF = 'dailyfresh.urls'
@@ -71,6 +73,8 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                # 页面头部的购物车商品数量
+                'cart.context_processors.cart_count',
             ],
         },
     },
@@ -144,6 +148,67 @@ CACHES = {
     }
 }
 
+# 保存用户购物车和浏览记录的redis节点，值是CACHES中的配置名称，按照用户id一致性哈希分片
+# 增加节点时在CACHES中添加配置，例如"user1": {..., "LOCATION": "redis://127.0.0.1:6380/6"}，
+# 发布时把REDIS_USER_SHARDS_PREVIOUS设置成旧的节点列表，然后执行python manage.py reshard_user_keys --from default迁移数据，
+# 迁移完成之后清空REDIS_USER_SHARDS_PREVIOUS
+REDIS_USER_SHARDS = ['default']
+REDIS_USER_SHARDS_PREVIOUS = []
+
+# 购物车和浏览记录的过期时间(秒)，每次访问时重新设置，0表示不过期
+CART_TTL = 30 * 24 * 3600
+HISTORY_TTL = 30 * 24 * 3600
+
+# 保存的历史浏览记录数目
+HISTORY_LENGTH = 5
+# 在后台线程中写浏览记录，详情页不等待redis, 以及写浏览记录的线程数
+HISTORY_ASYNC = False
+HISTORY_WRITE_WORKERS = 2
+
+# 商品SKU缓存: redis缓存的过期时间, 进程内LRU缓存的容量和过期时间
+SKU_CACHE_TIMEOUT = 300
+SKU_LOCAL_CACHE_SIZE = 1000
+SKU_LOCAL_CACHE_TIMEOUT = 30
+
+# 订单创建的策略: optimistic(条件update，不锁定商品)或者pessimistic(按照id的顺序select for update)
+ORDER_COMMIT_STRATEGY = 'optimistic'
+# 订单中有这些商品时使用ORDER_HOT_SKU_STRATEGY
+ORDER_HOT_SKUS = []
+ORDER_HOT_SKU_STRATEGY = 'pessimistic'
+# 订单创建的方式: sync(请求中创建)或者async(放入celery队列，前端查询/order/status获取结果)
+ORDER_COMMIT_MODE = 'sync'
+# 异步创建订单的celery队列
+ORDER_COMMIT_QUEUE = 'order'
+# 查询异步订单的结果时最多等待的秒数(长轮询)，等待期间占用web进程，0表示立即返回
+ORDER_STATUS_LONG_POLL_WAIT = 0
+# 生成订单id的机器号的租期(秒)，每过三分之一租期续租一次
+ORDER_WORKER_LEASE_TIMEOUT = 60
+
+# 秒杀商品在redis中预留库存的过期时间(秒)，超时没有结算时退回库存；每批结算的订单数目
+FLASH_RESERVATION_TIMEOUT = 600
+FLASH_SETTLE_BATCH_SIZE = 200
+# 结算一批订单的超时时间(秒)，结算的进程退出时超时的预留重新结算
+FLASH_SETTLE_TIMEOUT = 300
+
+# 热门商品的准入控制: 需要检查的视图{url名称: 商品id的参数名称}
+ADMISSION_VIEWS = {'order:commit': 'sku_ids', 'cart:add': 'sku_id'}
+# 每个商品每秒发放的令牌数目；拿到令牌之后可以直接通过的秒数；排队的用户超过这个秒数没有重试时移出队列
+ADMISSION_TOKENS_PER_SECOND = 50
+ADMISSION_PASS_TIMEOUT = 300
+ADMISSION_QUEUE_TIMEOUT = 30
+
+# 请求频率限制: {url名称: {'rate': 每秒补充的令牌数, 'burst': 允许的突发请求数, 'methods': 限制的请求方法}}
+# methods默认为POST, PUT, PATCH, DELETE; 登录用户按照用户id限制，没有登录时按照ip限制
+RATE_LIMITS = {
+    'cart:add': {'rate': 5, 'burst': 20},
+    'cart:update': {'rate': 10, 'burst': 30},
+    'cart:batch': {'rate': 2, 'burst': 5},
+    'order:commit': {'rate': 1, 'burst': 5},
+    'user:login': {'rate': 0.2, 'burst': 10, 'methods': ('POST',)},
+}
+# 可信的反向代理(nginx)的ip，来自这些地址的请求从X-Forwarded-For中获取客户端的ip
+RATE_LIMIT_TRUSTED_PROXIES = ['127.0.0.1']
+
 # 设置存储session
 SESSION_ENGINE = "django.contrib.sessions.backends.cache"
 SESSION_CACHE_ALIAS = "default"
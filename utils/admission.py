@@ -0,0 +1,144 @@
+# 热门商品的准入控制: 每个商品每秒最多发放settings.ADMISSION_TOKENS_PER_SECOND个令牌，
+# 拿不到令牌的用户按照到达的顺序排队，前端根据返回的排队位置稍后重试
+# 在中间件中只使用redis，被拒绝的请求不查询数据库
+# admission_skus: 开启准入控制的商品id的集合
+# admission_queue_商品id: {用户id: 到达时间} 排队的用户
+# admission_seen_商品id: {用户id: 最后一次请求的时间} 长时间没有重试的用户移出队列
+# admission_tokens_商品id_秒: 这一秒已经发放的令牌数目
+# admission_pass_商品id_用户id: 拿到令牌的用户在一段时间内可以直接通过
+from django.conf import settings
+from django.http import JsonResponse
+from django_redis import get_redis_connection
+import math
+import time
+
+ADMISSION_SKUS_KEY = 'admission_skus'
+# 一个请求最多检查的商品数目
+MAX_SKUS = 20
+# 每次清理队列头部的用户数目
+PRUNE_COUNT = 20
+
+# KEYS: admission_skus, 每个商品依次为queue, seen, tokens, pass
+# ARGV: 用户id, 当前时间, 每秒的令牌数, 通过的有效时间, 排队的超时时间, sku_id, ...
+# 返回{1}全部通过, 或者{0, 排队的商品id, 排队的位置}
+ADMIT_LUA = '''
+local user = ARGV[1]
+local now = tonumber(ARGV[2])
+local rate = tonumber(ARGV[3])
+local pass_ttl = tonumber(ARGV[4])
+local timeout = tonumber(ARGV[5])
+
+for i = 6, #ARGV do
+    local sku = ARGV[i]
+    local base = 1 + (i - 6) * 4
+    local queue, seen, tokens, pass = KEYS[base + 1], KEYS[base + 2], KEYS[base + 3], KEYS[base + 4]
+    if redis.call('sismember', KEYS[1], sku) == 1 and redis.call('exists', pass) == 0 then
+        -- 移除队列头部长时间没有重试的用户
+        for _, waiting in ipairs(redis.call('zrange', queue, 0, %(prune)d - 1)) do
+            local last = redis.call('hget', seen, waiting)
+            if not last or tonumber(last) < now - timeout then
+                redis.call('zrem', queue, waiting)
+                redis.call('hdel', seen, waiting)
+            end
+        end
+
+        if not redis.call('zscore', queue, user) then
+            redis.call('zadd', queue, now, user)
+        end
+        redis.call('hset', seen, user, now)
+        redis.call('expire', queue, timeout * 2)
+        redis.call('expire', seen, timeout * 2)
+
+        local position = redis.call('zrank', queue, user)
+        local available = rate - tonumber(redis.call('get', tokens) or '0')
+        if position >= available then
+            return {0, sku, position - math.max(available, 0) + 1}
+        end
+
+        -- 发放令牌
+        redis.call('incr', tokens)
+        redis.call('expire', tokens, 2)
+        redis.call('zrem', queue, user)
+        redis.call('hdel', seen, user)
+        redis.call('set', pass, 1, 'EX', pass_ttl)
+    end
+end
+return {1}
+''' % {'prune': PRUNE_COUNT}
+
+
+def enable_admission(sku_ids):
+    '''开启商品的准入控制'''
+    if sku_ids:
+        get_redis_connection('default').sadd(ADMISSION_SKUS_KEY, *sku_ids)
+
+
+def disable_admission(sku_ids):
+    '''关闭商品的准入控制'''
+    if sku_ids:
+        get_redis_connection('default').srem(ADMISSION_SKUS_KEY, *sku_ids)
+
+
+def get_admission_status():
+    '''返回{商品id: 排队的人数}'''
+    conn = get_redis_connection('default')
+    sku_ids = sorted(int(sku_id) for sku_id in conn.smembers(ADMISSION_SKUS_KEY))
+    pipe = conn.pipeline(transaction=False)
+    for sku_id in sku_ids:
+        pipe.zcard('admission_queue_%d' % sku_id)
+    return dict(zip(sku_ids, pipe.execute()))
+
+
+def admit(user_id, sku_ids, now=None):
+    '''
+    检查用户是否可以购买这些商品，一次redis调用完成
+    返回(是否通过, 排队的商品id, 排队的位置)
+    '''
+    sku_ids = [sku_id for sku_id in sku_ids if sku_id.isdigit()][:MAX_SKUS]
+    if not sku_ids:
+        return True, None, 0
+
+    now = time.time() if now is None else now
+    second = int(now)
+    keys = [ADMISSION_SKUS_KEY]
+    for sku_id in sku_ids:
+        keys.extend(['admission_queue_%s' % sku_id,
+                     'admission_seen_%s' % sku_id,
+                     'admission_tokens_%s_%d' % (sku_id, second),
+                     'admission_pass_%s_%s' % (sku_id, user_id)])
+    args = [user_id, now, settings.ADMISSION_TOKENS_PER_SECOND, settings.ADMISSION_PASS_TIMEOUT,
+            settings.ADMISSION_QUEUE_TIMEOUT] + sku_ids
+
+    conn = get_redis_connection('default')
+    result = conn.register_script(ADMIT_LUA)(keys=keys, args=args)
+    if result[0] == 1:
+        return True, None, 0
+    sku_id = result[1].decode() if isinstance(result[1], bytes) else result[1]
+    return False, int(sku_id), int(result[2])
+
+
+class AdmissionControlMiddleware(object):
+    '''
+    热门商品的准入控制，只检查settings.ADMISSION_VIEWS中的视图
+    ADMISSION_VIEWS: {url名称: 商品id的参数名称}，例如{'order:commit': 'sku_ids'}
+    '''
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if request.method != 'POST' or request.resolver_match is None:
+            return None
+        field = settings.ADMISSION_VIEWS.get(request.resolver_match.view_name)
+        if field is None:
+            return None
+
+        # 不查询数据库，从session中获取登录用户的id, 没有登录时由视图处理
+        user_id = request.session.get('_auth_user_id')
+        sku_ids = request.POST.get(field)
+        if not user_id or not sku_ids:
+            return None
+
+        ok, sku_id, position = admit(user_id, sku_ids.split(','))
+        if ok:
+            return None
+
+        retry_after = int(math.ceil(position / settings.ADMISSION_TOKENS_PER_SECOND))
+        return JsonResponse({'res':9, 'errmsg':'排队中，您排在第%d位' % position,
+                             'sku_id':sku_id, 'position':position, 'retry_after':max(retry_after, 1)})
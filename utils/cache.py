@@ -0,0 +1,140 @@
+from django.core.cache import cache
+from django_redis import get_redis_connection
+import time
+import uuid
+
+# 缓存数据过期之后，还可以作为旧数据继续使用的时间
+STALE_TIMEOUT = 3600
+# 重建缓存的锁的过期时间，防止重建缓存的进程挂掉之后锁一直不被释放
+LOCK_TIMEOUT = 10
+# 缓存中没有旧数据时，等待其他进程重建缓存的最长时间
+WAIT_TIMEOUT = 3
+# 等待其他进程重建缓存时，查询缓存的间隔
+WAIT_INTERVAL = 0.05
+
+# 只删除自己加的锁
+RELEASE_LOCK_SCRIPT = '''
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+'''
+
+
+class CacheEntry(object):
+    '''缓存中的一条数据'''
+    def __init__(self, value, stale=False):
+        self.value = value
+        # 数据已经过期或者版本不一致，正在等待重建
+        self.stale = stale
+
+
+def _lock_key(key):
+    return 'cache_lock_%s' % key
+
+
+def acquire_lock(key, timeout=LOCK_TIMEOUT):
+    '''获取重建缓存的锁，获取成功返回锁的标识，否则返回None'''
+    token = uuid.uuid4().hex
+    conn = get_redis_connection('default')
+    if conn.set(_lock_key(key), token, nx=True, ex=timeout):
+        return token
+    return None
+
+
+def release_lock(key, token):
+    '''释放重建缓存的锁'''
+    conn = get_redis_connection('default')
+    conn.eval(RELEASE_LOCK_SCRIPT, 1, _lock_key(key), token)
+
+
+def get_entries(keys, versions=None):
+    '''
+    批量获取缓存数据，返回{key: CacheEntry}
+    过期或者和versions中的版本不一致的数据标记为旧数据
+    '''
+    now = time.time()
+    result = {}
+    for key, data in cache.get_many(list(keys)).items():
+        stale = data['expires'] < now
+        if versions is not None and data['version'] != versions.get(key):
+            stale = True
+        result[key] = CacheEntry(data['value'], stale)
+    return result
+
+
+def set_entries(values, timeout, versions=None, stale_timeout=STALE_TIMEOUT):
+    '''批量设置缓存数据，数据过期后在stale_timeout内仍可以作为旧数据使用'''
+    expires = time.time() + timeout
+    data = {}
+    for key, value in values.items():
+        version = versions.get(key) if versions is not None else None
+        data[key] = {'value': value, 'expires': expires, 'version': version}
+    cache.set_many(data, timeout + stale_timeout)
+
+
+def get_many_or_set(keys, build, timeout, versions=None,
+                    lock_timeout=LOCK_TIMEOUT, wait_timeout=WAIT_TIMEOUT, stale_timeout=STALE_TIMEOUT):
+    '''
+    单飞模式批量获取缓存数据，防止缓存失效时多个进程同时重建
+    build(keys)->{key: value}，重建缓存中没有或者已经过期的数据
+    一个key同一时间只有获取到锁的进程会重建，其他进程继续使用旧数据；
+    没有旧数据时等待重建完成，超时后自己重建
+    返回({key: CacheEntry}, {重建的key: 重建耗时(微秒)})
+    '''
+    keys = list(keys)
+    entries = get_entries(keys, versions)
+
+    rebuild = []
+    waiting = []
+    tokens = {}
+    for key in keys:
+        entry = entries.get(key)
+        if entry is not None and not entry.stale:
+            continue
+
+        token = acquire_lock(key, lock_timeout)
+        if token is not None:
+            # 由当前进程重建
+            tokens[key] = token
+            rebuild.append(key)
+        elif entry is None:
+            # 其他进程正在重建，并且没有旧数据可以使用
+            waiting.append(key)
+
+    # 等待其他进程重建完成
+    deadline = time.time() + wait_timeout
+    while waiting and time.time() < deadline:
+        time.sleep(WAIT_INTERVAL)
+        filled = get_entries(waiting, versions)
+        entries.update(filled)
+        waiting = [key for key in waiting if key not in filled]
+    # 等待超时，自己重建
+    rebuild.extend(waiting)
+
+    costs = {}
+    if rebuild:
+        try:
+            start = time.time()
+            built = build(rebuild)
+            cost = int((time.time() - start) * 1000000 / len(rebuild))
+
+            set_entries(built, timeout, versions, stale_timeout)
+            for key, value in built.items():
+                entries[key] = CacheEntry(value)
+                costs[key] = cost
+        finally:
+            for key, token in tokens.items():
+                release_lock(key, token)
+
+    return entries, costs
+
+
+def get_or_set(key, build, timeout, version=None, **kwargs):
+    '''
+    单飞模式获取一个缓存数据, 用来代替cache.get/cache.set
+    build()->value
+    '''
+    versions = {key: version} if version is not None else None
+    entries, costs = get_many_or_set([key], lambda keys: {key: build()}, timeout, versions, **kwargs)
+    return entries[key].value
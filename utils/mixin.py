@@ -6,4 +6,5 @@ class LoginRequiredMixin(object):
     def as_view(cls, **initkwargs):
         # 首先调用父类的as_view
         view = super(LoginRequiredMixin, cls).as_view(**initkwargs)
-        return login_required(view)
\ No newline at end of file
+        return login_required(view)
+
@@ -0,0 +1,158 @@
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+import base64
+import datetime
+import decimal
+import json
+import math
+
+
+def page_range(num_pages, page):
+    '''
+    控制页码的列表，最多在页面上只显示5个页码
+    1.总页数小于5页，显示所有页码
+    2.当前页属于前3页，显示前5页
+    3.当前页属于后3页，显示后5页
+    4.其他情况，显示当前页的前2页，当前页，当前页后2页
+    '''
+    if num_pages < 5:
+        return range(1, num_pages+1)
+    elif page <= 3:
+        return range(1, 6)
+    elif num_pages - page <= 2:
+        return range(num_pages-4, num_pages+1)
+    else:
+        return range(page-2, page+3)
+
+
+def parse_page(page):
+    '''处理页码，页码出错时返回1'''
+    try:
+        page = int(page)
+    except Exception as e:
+        # 页码出错
+        return 1
+    return page if page >= 1 else 1
+
+
+def encode_cursor(values):
+    '''把一条数据的排序字段的值编码成游标'''
+    values = [str(value) if isinstance(value, decimal.Decimal) else
+              value.isoformat() if isinstance(value, datetime.datetime) else value
+              for value in values]
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor, size):
+    '''解码游标，游标不合法时返回None'''
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except Exception as e:
+        return None
+    if not isinstance(values, list) or len(values) != size:
+        return None
+    return values
+
+
+def keyset_filter(queryset, ordering, values, backward=False):
+    '''
+    返回排在游标之后(backward时为之前)的数据
+    ordering: 排序字段，最后一个字段必须唯一, 例如['price', 'id'], ['-sales', '-id']
+    (a, b) > (x, y) 展开成 a > x or (a = x and b > y)
+    '''
+    condition = Q()
+    equal = Q()
+    for field, value in zip(ordering, values):
+        desc = field.startswith('-')
+        name = field.lstrip('-')
+        lookup = 'lt' if desc != backward else 'gt'
+        condition |= equal & Q(**{'%s__%s' % (name, lookup): value})
+        equal &= Q(**{name: value})
+    return queryset.filter(condition)
+
+
+def get_num_pages(count, per_page):
+    return max(int(math.ceil(count / per_page)), 1)
+
+
+def _reverse_ordering(ordering):
+    return [field[1:] if field.startswith('-') else '-' + field for field in ordering]
+
+
+class KeysetPage(object):
+    '''游标分页的一页数据，和Paginator返回的Page对象在模板中的用法相同'''
+    def __init__(self, object_list, number, num_pages, ordering):
+        self.object_list = object_list
+        self.number = number
+        self.num_pages = num_pages
+        self.ordering = ordering
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.number < self.num_pages
+
+    def has_previous(self):
+        return self.number > 1
+
+    def next_page_number(self):
+        return self.number + 1
+
+    def previous_page_number(self):
+        return self.number - 1
+
+    def _cursor(self, obj):
+        return encode_cursor([getattr(obj, field.lstrip('-')) for field in self.ordering])
+
+    @property
+    def next_cursor(self):
+        '''下一页的游标: 当前页最后一条数据'''
+        return self._cursor(self.object_list[-1]) if self.object_list else ''
+
+    @property
+    def previous_cursor(self):
+        '''上一页的游标: 当前页第一条数据'''
+        return self._cursor(self.object_list[0]) if self.object_list else ''
+
+
+def keyset_paginate(queryset, ordering, page, per_page, count, after=None, before=None):
+    '''
+    分页查询，不执行COUNT(*)，总数目count由调用者提供(一般从缓存中获取)
+    after/before: 上一页的最后一条/下一页的第一条数据的游标，按照(排序字段, id)定位，不需要OFFSET扫描；
+    没有游标时(直接跳转到某一页)才使用OFFSET
+    '''
+    num_pages = get_num_pages(count, per_page)
+    page = parse_page(page)
+    if page > num_pages:
+        page = 1
+
+    object_list = None
+    try:
+        if after:
+            values = decode_cursor(after, len(ordering))
+            if values is not None:
+                object_list = list(keyset_filter(queryset, ordering, values).order_by(*ordering)[:per_page])
+        elif before:
+            values = decode_cursor(before, len(ordering))
+            if values is not None:
+                object_list = list(keyset_filter(queryset, ordering, values, backward=True)
+                                   .order_by(*_reverse_ordering(ordering))[:per_page])
+                object_list.reverse()
+    except (ValidationError, ValueError, TypeError) as e:
+        # 游标中的值和字段的类型不符(被修改过)
+        object_list = None
+
+    if not object_list:
+        # 没有游标，游标不合法或者数据已经变化
+        offset = (page - 1) * per_page
+        object_list = list(queryset.order_by(*ordering)[offset:offset + per_page])
+        if not object_list and page > 1:
+            # 缓存的总数目比实际的多
+            page = 1
+            object_list = list(queryset.order_by(*ordering)[:per_page])
+
+    return KeysetPage(object_list, page, num_pages, ordering)
@@ -0,0 +1,114 @@
+# 请求频率限制: 令牌桶，一个redis脚本完成令牌的补充和扣除
+# settings.RATE_LIMITS: {url名称: {'rate': 每秒补充的令牌数, 'burst': 桶的容量, 'methods': 限制的请求方法}}
+# 登录用户按照用户id限制，没有登录时按照ip限制
+# 经过settings.RATE_LIMIT_TRUSTED_PROXIES中的代理时，客户端的ip从X-Forwarded-For中获取
+# rate_limit_url名称_user_用户id / rate_limit_url名称_ip_ip地址: {'tokens': 剩余令牌, 'ts': 上次补充的时间}
+# rate_limit_throttled: {url名称: 被拒绝的请求数目}
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse
+from django_redis import get_redis_connection
+import math
+import time
+
+RATE_LIMIT_STATS_KEY = 'rate_limit_throttled'
+# 没有配置methods时只限制修改数据的请求，GET请求(例如显示登录页)不消耗令牌
+DEFAULT_METHODS = ('POST', 'PUT', 'PATCH', 'DELETE')
+
+# KEYS: 令牌桶, rate_limit_throttled  ARGV: rate, burst, 当前时间, url名称
+# 返回{是否通过, 需要等待的秒数}
+TOKEN_BUCKET_LUA = '''
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+
+local bucket = redis.call('hmget', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or burst
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+
+local allowed = 0
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+else
+    wait = (1 - tokens) / rate
+    redis.call('hincrby', KEYS[2], ARGV[4], 1)
+end
+redis.call('hmset', KEYS[1], 'tokens', tostring(tokens), 'ts', ARGV[3])
+-- 令牌桶补满之后和不存在的效果相同
+redis.call('expire', KEYS[1], math.ceil(burst / rate) + 1)
+return {allowed, tostring(wait)}
+'''
+
+
+def _client_key(request):
+    '''登录用户返回user_用户id，否则返回ip_ip地址，不查询数据库'''
+    user_id = request.session.get('_auth_user_id')
+    if user_id:
+        return 'user_%s' % user_id
+    return 'ip_%s' % get_client_ip(request)
+
+
+def get_client_ip(request):
+    '''
+    返回客户端的ip
+    请求来自可信的代理时，从右向左跳过X-Forwarded-For中可信的代理，第一个不可信的地址就是客户端
+    '''
+    ip = request.META.get('REMOTE_ADDR', '')
+    trusted = settings.RATE_LIMIT_TRUSTED_PROXIES
+    if ip not in trusted:
+        return ip
+    forwarded = [addr.strip() for addr in request.META.get('HTTP_X_FORWARDED_FOR', '').split(',') if addr.strip()]
+    for addr in reversed(forwarded):
+        if addr not in trusted:
+            return addr
+        ip = addr
+    return ip
+
+
+def check_rate_limit(request, name):
+    '''
+    检查请求是否超过name的频率限制，name没有配置时不限制
+    返回(是否通过, 需要等待的秒数)
+    '''
+    limit = settings.RATE_LIMITS.get(name)
+    if limit is None or request.method not in limit.get('methods', DEFAULT_METHODS):
+        return True, 0
+
+    keys = ['rate_limit_%s_%s' % (name, _client_key(request)), RATE_LIMIT_STATS_KEY]
+    args = [limit['rate'], limit['burst'], time.time(), name]
+    conn = get_redis_connection('default')
+    allowed, wait = conn.register_script(TOKEN_BUCKET_LUA)(keys=keys, args=args)
+    return allowed == 1, float(wait)
+
+
+def throttled_response(request, wait):
+    '''ajax请求返回和视图相同格式的json，其他请求返回429'''
+    retry_after = max(int(math.ceil(wait)), 1)
+    if request.is_ajax():
+        return JsonResponse({'res':10, 'errmsg':'请求过于频繁，请稍后再试', 'retry_after':retry_after})
+    response = HttpResponse('请求过于频繁，请稍后再试', status=429)
+    response['Retry-After'] = retry_after
+    return response
+
+
+def get_throttle_stats():
+    '''返回{url名称: 被拒绝的请求数目}'''
+    conn = get_redis_connection('default')
+    return {name.decode(): int(count) for name, count in conn.hgetall(RATE_LIMIT_STATS_KEY).items()}
+
+
+def reset_throttle_stats():
+    get_redis_connection('default').delete(RATE_LIMIT_STATS_KEY)
+
+
+class RateLimitMiddleware(object):
+    '''对settings.RATE_LIMITS中的视图限制请求频率，在视图执行之前拒绝'''
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if request.resolver_match is None:
+            return None
+        ok, wait = check_rate_limit(request, request.resolver_match.view_name)
+        if ok:
+            return None
+        return throttled_response(request, wait)
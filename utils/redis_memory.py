@@ -0,0 +1,151 @@
+# redis的内存管理: 清理长时间没有访问的购物车和浏览记录，统计每类key占用的内存
+# 都使用SCAN分批遍历，不会长时间阻塞redis
+from django.conf import settings
+from django_redis import get_redis_connection
+from utils.redis_router import get_ring, parse_user_key
+from collections import OrderedDict
+import json
+import time
+
+# 统计内存时key的分类: (前缀, 名称)，按照顺序匹配
+KEY_FAMILIES = [
+    ('cart_total_', 'cart_total'),
+    ('cart_', 'cart'),
+    ('history_', 'history'),
+    ('type_rank_', 'type_rank'),
+    ('sku_stock', 'sku_stock'),
+    ('cache_lock_', 'cache_lock'),
+    ('admission_', 'admission'),
+    ('rate_limit_', 'rate_limit'),
+    ('order_worker_', 'order_worker'),
+    (':1:django.contrib.sessions', 'session'),
+    (':1:', 'django_cache'),
+]
+
+
+def _user_key_ttls():
+    '''按照用户分片的key的过期时间 {前缀: 秒}'''
+    return {'cart': settings.CART_TTL, 'cart_total': settings.CART_TTL, 'history': settings.HISTORY_TTL}
+
+
+def _scan_batches(conn, match=None, count=500):
+    '''分批返回SCAN的结果'''
+    cursor = 0
+    while True:
+        cursor, keys = conn.scan(cursor, match=match, count=count)
+        if keys:
+            yield keys
+        if int(cursor) == 0:
+            break
+
+
+def _archive_value(conn, key, prefix):
+    if prefix == 'cart':
+        return {k.decode(): int(v) for k, v in conn.hgetall(key).items()}
+    if prefix == 'history':
+        return [int(v) for v in conn.lrange(key, 0, -1)]
+    return None
+
+
+def sweep_user_keys(nodes=None, count=500, pause=0, archive=None, dry_run=False):
+    '''
+    清理没有设置过期时间的购物车和浏览记录(设置过期时间之前创建的key)
+    空闲时间(OBJECT IDLETIME)超过settings中的过期时间的key删除，删除之前可以写入archive归档;
+    其他的key按照剩余的时间设置过期时间
+    count: 每批SCAN的key数目  pause: 每批之间暂停的秒数
+    archive: 归档文件对象，每行一个json {key, user_id, value}
+    返回{节点: {'scanned': 遍历数目, 'expired': 设置过期时间的数目, 'removed': 删除数目}}
+    '''
+    ttls = _user_key_ttls()
+    stats = OrderedDict()
+    for node in get_ring(nodes).nodes:
+        conn = get_redis_connection(node)
+        item = stats[node] = {'scanned': 0, 'expired': 0, 'removed': 0}
+        for pattern in ('cart_*', 'history_*'):
+            for keys in _scan_batches(conn, pattern, count):
+                keys = [(key, parse_user_key(key)) for key in keys]
+                keys = [(key, prefix, user_id) for key, (prefix, user_id) in keys
+                        if user_id is not None and ttls[prefix]]
+                item['scanned'] += len(keys)
+
+                pipe = conn.pipeline(transaction=False)
+                for key, prefix, user_id in keys:
+                    pipe.ttl(key)
+                    pipe.execute_command('OBJECT', 'IDLETIME', key)
+                results = pipe.execute() if keys else []
+
+                pipe = conn.pipeline(transaction=False)
+                for i, (key, prefix, user_id) in enumerate(keys):
+                    ttl, idle = results[i * 2], results[i * 2 + 1]
+                    if ttl is None or idle is None or ttl != -1:
+                        # key已经删除或者已经设置了过期时间
+                        continue
+                    if idle >= ttls[prefix]:
+                        item['removed'] += 1
+                        if dry_run:
+                            continue
+                        if archive is not None and prefix != 'cart_total':
+                            archive.write(json.dumps({'key': key.decode(), 'user_id': user_id,
+                                                      'value': _archive_value(conn, key, prefix)}) + '\n')
+                        pipe.delete(key)
+                    else:
+                        item['expired'] += 1
+                        if not dry_run:
+                            pipe.expire(key, ttls[prefix] - idle)
+                pipe.execute()
+
+                if pause:
+                    time.sleep(pause)
+    return stats
+
+
+def key_family(key):
+    '''返回key的分类名称'''
+    if isinstance(key, bytes):
+        key = key.decode(errors='replace')
+    for prefix, name in KEY_FAMILIES:
+        if key.startswith(prefix):
+            return name
+    return 'other'
+
+
+def memory_report(node='default', sample=100, count=1000):
+    '''
+    统计一个节点上每类key的数目和占用的内存
+    遍历全部的key计数，每类只对前sample个key执行MEMORY USAGE和OBJECT ENCODING
+    返回{分类: {'keys': 数目, 'sampled': 采样数目, 'avg_bytes': 平均字节数,
+               'total_bytes': 估计的总字节数, 'encodings': {编码: 数目}}}
+    '''
+    conn = get_redis_connection(node)
+    report = OrderedDict((name, {'keys': 0, 'sampled': 0, 'sample_bytes': 0, 'encodings': {}})
+                         for name in [name for prefix, name in KEY_FAMILIES] + ['other'])
+    for keys in _scan_batches(conn, count=count):
+        sampled = []
+        for key in keys:
+            item = report[key_family(key)]
+            item['keys'] += 1
+            if item['sampled'] < sample:
+                item['sampled'] += 1
+                sampled.append((key, item))
+
+        pipe = conn.pipeline(transaction=False)
+        for key, item in sampled:
+            pipe.execute_command('MEMORY', 'USAGE', key)
+            pipe.execute_command('OBJECT', 'ENCODING', key)
+        results = pipe.execute() if sampled else []
+
+        for i, (key, item) in enumerate(sampled):
+            size, encoding = results[i * 2], results[i * 2 + 1]
+            if size is None:
+                # 采样之前key已经删除
+                item['sampled'] -= 1
+                continue
+            item['sample_bytes'] += size
+            encoding = encoding.decode() if isinstance(encoding, bytes) else str(encoding)
+            item['encodings'][encoding] = item['encodings'].get(encoding, 0) + 1
+
+    for item in report.values():
+        item['avg_bytes'] = item['sample_bytes'] / item['sampled'] if item['sampled'] else 0
+        item['total_bytes'] = int(item['avg_bytes'] * item['keys'])
+        del item['sample_bytes']
+    return report
@@ -0,0 +1,181 @@
+# 按照用户id把用户的购物车和浏览记录分散到多个redis节点
+# 节点是settings.CACHES中的配置名称，由settings.REDIS_USER_SHARDS指定，没有配置时只使用default
+# 同一个用户的全部key在同一个节点上，lua脚本可以同时操作用户的多个key
+# 使用一致性哈希，增加或者减少节点时只有少部分用户需要迁移
+# 迁移期间settings.REDIS_USER_SHARDS_PREVIOUS是变化之前的节点列表，用户第一次访问时把旧的节点上的key移到新的节点
+from django.conf import settings
+from django_redis import get_redis_connection
+from redis.exceptions import ResponseError
+import bisect
+import hashlib
+import re
+
+# 每个节点在哈希环上的虚拟节点数目
+VIRTUAL_NODES = 160
+
+# 按照用户id分片的key: 购物车记录，购物车中商品的总件数，浏览记录
+USER_KEY_PREFIXES = ('cart', 'cart_total', 'history')
+USER_KEY_RE = re.compile(r'^(%s)_(\d+)$' % '|'.join(USER_KEY_PREFIXES))
+
+
+def _hash(value):
+    return int(hashlib.md5(value.encode()).hexdigest()[:8], 16)
+
+
+class HashRing(object):
+    '''一致性哈希环'''
+    def __init__(self, nodes, virtual_nodes=VIRTUAL_NODES):
+        self.nodes = list(nodes)
+        ring = sorted((_hash('%s-%d' % (node, i)), node)
+                      for node in self.nodes for i in range(virtual_nodes))
+        self._hashes = [h for h, node in ring]
+        self._nodes = [node for h, node in ring]
+
+    def get_node(self, key):
+        '''返回key所在的节点'''
+        if len(self.nodes) == 1:
+            return self.nodes[0]
+        index = bisect.bisect(self._hashes, _hash(str(key))) % len(self._hashes)
+        return self._nodes[index]
+
+
+_rings = {}
+
+
+def get_ring(nodes=None):
+    '''返回节点列表对应的哈希环，默认使用settings.REDIS_USER_SHARDS'''
+    if nodes is None:
+        nodes = getattr(settings, 'REDIS_USER_SHARDS', None) or ['default']
+    nodes = tuple(nodes)
+    if nodes not in _rings:
+        _rings[nodes] = HashRing(nodes)
+    return _rings[nodes]
+
+
+def get_user_node(user_id, nodes=None):
+    '''返回用户的key所在的节点'''
+    return get_ring(nodes).get_node(int(user_id))
+
+
+def get_user_connection(user_id):
+    '''
+    返回用户的key所在节点的redis连接，用来代替get_redis_connection('default')
+    迁移期间用户的节点变化时，先把旧的节点上的key移过来，不会读到空的购物车
+    '''
+    node = get_user_node(user_id)
+    previous = getattr(settings, 'REDIS_USER_SHARDS_PREVIOUS', None)
+    if previous:
+        old_node = get_user_node(user_id, previous)
+        if old_node != node:
+            migrate_user(int(user_id), old_node, node)
+    return get_redis_connection(node)
+
+
+def get_shard_connections(nodes=None):
+    '''返回全部节点的redis连接 {节点: 连接}'''
+    return {node: get_redis_connection(node) for node in get_ring(nodes).nodes}
+
+
+def parse_user_key(key):
+    '''返回按照用户分片的key的(前缀, 用户id)，不是按照用户分片的key时返回(None, None)'''
+    if isinstance(key, bytes):
+        key = key.decode()
+    match = USER_KEY_RE.match(key)
+    if match is None:
+        return None, None
+    return match.group(1), int(match.group(2))
+
+
+def _merge_key(src, dst, key, prefix):
+    '''新的节点上已经有这个key时合并: 购物车中同一个商品保留新的数目，浏览记录中旧的记录排在后面'''
+    if prefix == 'cart':
+        old = src.hgetall(key)
+        if old:
+            pipe = dst.pipeline()
+            for sku_id, count in old.items():
+                pipe.hsetnx(key, sku_id, count)
+            pipe.execute()
+    else:
+        new = dst.lrange(key, 0, -1)
+        old = [sku_id for sku_id in src.lrange(key, 0, -1) if sku_id not in new]
+        if old:
+            pipe = dst.pipeline()
+            pipe.rpush(key, *old)
+            pipe.ltrim(key, 0, settings.HISTORY_LENGTH - 1)
+            pipe.execute()
+
+
+def _move_key(src, dst, key, prefix, user_id):
+    '''
+    用DUMP/RESTORE复制数据和剩余的过期时间，然后删除旧的key
+    返回'moved', 'merged'或者None(旧的节点上没有这个key)
+    '''
+    pipe = src.pipeline(transaction=False)
+    pipe.dump(key)
+    pipe.pttl(key)
+    data, pttl = pipe.execute()
+    if data is None:
+        return None
+    try:
+        dst.restore(key, pttl if pttl > 0 else 0, data)
+        result = 'moved'
+    except ResponseError:
+        # BUSYKEY: 迁移之前用户已经在新的节点上修改过
+        _merge_key(src, dst, key, prefix)
+        result = 'merged'
+    if prefix == 'cart':
+        # 新的节点上的总件数可能是在没有购物车记录时创建的，删除之后从购物车记录重新计算
+        dst.delete('cart_total_%d' % user_id)
+    src.delete(*([key, 'cart_total_%d' % user_id] if prefix == 'cart' else [key]))
+    return result
+
+
+def migrate_user(user_id, old_node, new_node):
+    '''把一个用户的购物车和浏览记录从旧的节点移到新的节点'''
+    src = get_redis_connection(old_node)
+    dst = get_redis_connection(new_node)
+    for prefix in ('cart', 'history'):
+        _move_key(src, dst, '%s_%d' % (prefix, user_id), prefix, user_id)
+
+
+def migrate_user_keys(old_nodes, new_nodes=None, scan_count=500, dry_run=False):
+    '''
+    节点变化后把用户的key从旧的节点迁移到新的节点，网站不需要停止服务
+    先发布新的settings.REDIS_USER_SHARDS，同时把REDIS_USER_SHARDS_PREVIOUS设置成旧的节点列表，再执行迁移，
+    迁移完成之后清空REDIS_USER_SHARDS_PREVIOUS。迁移期间用户访问时由get_user_connection移动自己的key
+    新的节点上已经有这个key时(迁移之前用户又修改过)合并两边的数据
+    购物车中商品的总件数不迁移，直接删除，下次访问购物车时从购物车记录重新计算
+    返回{旧的节点: {'moved': 迁移数目, 'conflicts': 合并数目, 'dropped': 删除数目}}
+    '''
+    old_ring = get_ring(old_nodes)
+    new_ring = get_ring(new_nodes)
+    stats = {}
+    for node in old_ring.nodes:
+        src = get_redis_connection(node)
+        item = stats[node] = {'moved': 0, 'conflicts': 0, 'dropped': 0}
+        for pattern in ('cart_*', 'history_*'):
+            # cart_*同时匹配cart_total_*
+            for key in src.scan_iter(match=pattern, count=scan_count):
+                prefix, user_id = parse_user_key(key)
+                if user_id is None:
+                    continue
+                target = new_ring.get_node(user_id)
+                if target == node:
+                    continue
+
+                if prefix == 'cart_total':
+                    item['dropped'] += 1 if dry_run else src.delete(key)
+                    continue
+
+                if dry_run:
+                    item['moved'] += 1
+                    continue
+
+                # 已经迁移或者过期时返回None
+                result = _move_key(src, get_redis_connection(target), key, prefix, user_id)
+                if result == 'moved':
+                    item['moved'] += 1
+                elif result == 'merged':
+                    item['conflicts'] += 1
+    return stats
+
@@ -0,0 +1,59 @@
+import gzip
+import hashlib
+import io
+import os
+import tempfile
+
+
+def _content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _file_hash(path):
+    '''返回已发布文件内容的hash，文件不存在时返回None'''
+    try:
+        with open(path, 'rb') as f:
+            return _content_hash(f.read())
+    except FileNotFoundError:
+        return None
+
+
+def _gzip(data):
+    '''压缩内容, 固定mtime使相同的内容得到相同的压缩文件'''
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9, mtime=0) as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+def write_atomic(path, data):
+    '''先写入同一目录下的临时文件，再原子地重命名，nginx不会读到写了一半的文件'''
+    dirname = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.%s.' % os.path.basename(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def publish_static_page(path, content):
+    '''
+    发布静态页，同时生成nginx gzip_static使用的.gz文件
+    内容和已发布的版本相同时不重写文件，返回是否发布了新的内容
+    '''
+    data = content.encode('utf-8')
+    if _content_hash(data) == _file_hash(path) and os.path.exists(path + '.gz'):
+        return False
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # 先发布压缩文件，再发布页面
+    write_atomic(path + '.gz', _gzip(data))
+    write_atomic(path, data)
+    return True